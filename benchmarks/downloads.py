@@ -0,0 +1,122 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Benchmark the thread and process download backends against
+                a local mock of the Wunderground daily history page
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:
+Last Modified:
+License:        Apache 2.0
+Notes:          * Usage: python benchmarks/downloads.py [-n DAYS]
+                  [-w WORKERS [WORKERS ...]] [-d DELAY]
+                * The mock server runs in its own process and answers every
+                  request after DELAY seconds, which stands in for the
+                  network latency
+'''
+
+import argparse
+import BaseHTTPServer
+import shutil
+import SocketServer
+import tempfile
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Process, Value
+from download_wunderground.get_data import download_station
+from download_wunderground.get_data import DOWNLOAD_BACKENDS
+
+HEADER = ('Time,TemperatureC,DewpointC,PressurehPa,WindDirection,' +
+          'WindDirectionDegrees,WindSpeedKMH,WindSpeedGustKMH,Humidity,' +
+          'HourlyPrecipMM,Conditions,Clouds,dailyrainMM,SoftwareType,' +
+          'DateUTC')
+ROW = ('{0:%Y-%m-%d %H:%M:%S},5.2,3.1,1012.3,WSW,250,11.3,17.7,87,0.0,,,' +
+       '0.0,WeatherLink,{0:%Y-%m-%d %H:%M:%S}')
+
+def daily_payload(samples=288):
+    '''
+    return a daily history page with samples rows at a regular interval
+    '''
+    start = datetime(2016, 1, 1)
+    step = timedelta(seconds=86400 // samples)
+    rows = [ROW.format(start + idx * step) for idx in range(samples)]
+    return '\n' + '\n<br>\n'.join([HEADER] + rows) + '\n<br>\n'
+
+class mock_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    answer every GET with the daily payload after the server delay, the
+    connection is kept open (HTTP/1.1) for clients that reuse it
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.connections.get_lock():
+            self.server.connections.value += 1
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(self.server.payload)))
+        self.end_headers()
+        self.wfile.write(self.server.payload)
+
+    def log_message(self, *args):
+        pass
+
+class mock_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def start_server(delay):
+    '''
+    start the mock server in a background process and return it, the
+    server does not compete with the benchmarked threads for the GIL
+    '''
+    server = mock_server(('127.0.0.1', 0), mock_handler)
+    server.delay = delay
+    server.payload = daily_payload()
+    server.connections = Value('i', 0)
+    process = Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    return server
+
+def run(server, backend, workers, days):
+    '''
+    return the wall clock time and the number of new connections of
+    downloading days daily files with backend and workers
+    '''
+    url = 'http://127.0.0.1:%i/weatherstation/WXDailyHistory.asp' % \
+        server.server_address[1]
+    outputdir = tempfile.mkdtemp()
+    connections = server.connections.value
+    try:
+        start = time.time()
+        download_station('IBENCH1', datetime(2016, 1, 1),
+                         datetime(2016, 1, 1) + timedelta(days=days - 1),
+                         outputdir, backend=backend, workers=workers,
+                         history_url=url, progress=False)
+        return time.time() - start, server.connections.value - connections
+    finally:
+        shutil.rmtree(outputdir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the download ' +
+                                     'backends')
+    parser.add_argument('-n', '--days', type=int, default=1024,
+                        help='Number of daily files to download')
+    parser.add_argument('-w', '--workers', type=int, nargs='+',
+                        default=[8, 64, 256],
+                        help='Numbers of simultaneous downloads')
+    parser.add_argument('-d', '--delay', type=float, default=0.05,
+                        help='Response delay of the mock server (s)')
+    opts = parser.parse_args()
+    server = start_server(opts.delay)
+    print('%-8s %7s %9s %10s %11s' % ('backend', 'workers', 'time (s)',
+                                      'files/s', 'connections'))
+    for workers in opts.workers:
+        for backend in DOWNLOAD_BACKENDS:
+            elapsed, connections = run(server, backend, workers, opts.days)
+            print('%-8s %7i %9.2f %10.1f %11i' % (
+                backend, workers, elapsed, opts.days / elapsed, connections))
@@ -0,0 +1,315 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Replay a corpus of daily Wunderground payloads through the
+                csv parser and the netCDF converter, check the output
+                against a recorded reference and report the throughput
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:
+Last Modified:
+License:        Apache 2.0
+Notes:          * Usage: python benchmarks/replay.py [-c CORPUS] [-d DAYS]
+                  [--record REFERENCE | --reference REFERENCE]
+                  [--chunk {day,month,year}] [--qc] [-a {hourly,daily}]
+                * A corpus is a directory with a subdirectory of daily raw
+                  files per station, e.g. the TMP_DIR of a download with
+                  --keep. Without --corpus a corpus with the known input
+                  variants (see VARIANTS) is synthesized.
+                * The reference stores a digest of every netCDF variable
+                  and its attributes per station, --reference exits with
+                  status 1 if any station differs.
+                  replay_reference.json is the reference of the default
+                  synthesized corpus, record it again after an intended
+                  change of the output
+'''
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from netCDF4 import Dataset as ncdf
+from download_wunderground.create_netcdf import process_raw_data
+
+METRIC = ['Time', 'TemperatureC', 'DewpointC', 'PressurehPa',
+          'WindDirection', 'WindDirectionDegrees', 'WindSpeedKMH',
+          'WindSpeedGustKMH', 'Humidity', 'HourlyPrecipMM', 'Conditions',
+          'Clouds', 'dailyrainMM', 'SolarRadiationWatts/m^2', 'SoftwareType',
+          'DateUTC']
+IMPERIAL = ['Time', 'TemperatureF', 'DewpointF', 'PressureIn',
+            'WindDirection', 'WindDirectionDegrees', 'WindSpeedMPH',
+            'WindSpeedGustMPH', 'Humidity', 'HourlyPrecipIn', 'Conditions',
+            'Clouds', 'dailyrainin', 'SoftwareType', 'DateUTC']
+# input variants seen in downloaded files:
+#   metric/imperial: complete days in station units
+#   utc_last: DateUTC is the last column, its header ends in <br>
+#   missing_columns: station without wind, pressure and rain sensors
+#   messy: unsorted and duplicate rows, invalid times, missing values,
+#          variable wind direction, empty and header-only days
+#   leading_blank: an empty line before the header
+VARIANTS = ['metric', 'imperial', 'utc_last', 'missing_columns', 'messy',
+            'leading_blank']
+# global attributes that depend on the time or place of the conversion
+VOLATILE_ATTRIBUTES = ['history', 'description']
+
+def sample_values(field_name, rnd, minute):
+    '''
+    return a plausible raw value of field_name at minute of the day
+    '''
+    temperature = 5. + 5. * rnd.random() + minute / 240.
+    values = {'TemperatureC': '%.1f' % temperature,
+              'DewpointC': '%.1f' % (temperature - 2.),
+              'TemperatureF': '%.1f' % (temperature * 1.8 + 32.),
+              'DewpointF': '%.1f' % ((temperature - 2.) * 1.8 + 32.),
+              'PressurehPa': '%.1f' % (1005. + 10. * rnd.random()),
+              'PressureIn': '%.2f' % (29.7 + 0.3 * rnd.random()),
+              'WindDirection': rnd.choice(['SW', 'WSW', 'N', 'Calm']),
+              'WindDirectionDegrees': str(rnd.randint(0, 359)),
+              'WindSpeedKMH': '%.1f' % (20. * rnd.random()),
+              'WindSpeedGustKMH': '%.1f' % (30. * rnd.random()),
+              'WindSpeedMPH': '%.1f' % (12. * rnd.random()),
+              'WindSpeedGustMPH': '%.1f' % (18. * rnd.random()),
+              'Humidity': str(rnd.randint(40, 100)),
+              'HourlyPrecipMM': '%.1f' % (rnd.random() < 0.1),
+              'HourlyPrecipIn': '%.2f' % (0.04 * (rnd.random() < 0.1)),
+              'Conditions': '', 'Clouds': '',
+              'dailyrainMM': '%.1f' % (minute / 600.),
+              'dailyrainin': '%.2f' % (minute / 15000.),
+              'SolarRadiationWatts/m^2': '%.0f' % max(
+                  0., 500. - abs(minute - 720) * 0.8),
+              'SoftwareType': 'WS-2350'}
+    return values[field_name]
+
+def daily_payload(variant, day, rnd):
+    '''
+    return the raw file of a day of a station of variant, in the format
+    written by get_daily_wunderground
+    '''
+    columns = IMPERIAL if variant == 'imperial' else METRIC
+    if variant == 'missing_columns':
+        columns = ['Time', 'TemperatureC', 'Humidity', 'SoftwareType',
+                   'DateUTC']
+    elif variant == 'utc_last':
+        columns = [c for c in METRIC if c != 'DateUTC'] + ['DateUTC']
+    else:
+        # DateUTC is usually followed by SoftwareType
+        columns = [c for c in columns if c not in ['DateUTC',
+                                                    'SoftwareType']] + \
+            ['DateUTC', 'SoftwareType']
+    if variant == 'messy' and day.day % 10 == 0:
+        # empty day, file without any content
+        return ''
+    header = ','.join(columns) + '<br>\n'
+    if variant == 'leading_blank':
+        header = '\n' + header
+    if variant == 'messy' and day.day % 10 == 5:
+        # day without observations
+        return header
+    rows = []
+    for minute in range(0, 1440, 5):
+        local = day + timedelta(minutes=minute)
+        utc = local - timedelta(hours=1)
+        values = []
+        for column in columns:
+            if column == 'Time':
+                values.append(local.strftime('%Y-%m-%d %H:%M:%S'))
+            elif column == 'DateUTC':
+                values.append(utc.strftime('%Y-%m-%d %H:%M:%S'))
+            else:
+                values.append(sample_values(column, rnd, minute))
+        if variant == 'messy':
+            if rnd.random() < 0.02:
+                values[columns.index('TemperatureC')] = '-999'
+            if rnd.random() < 0.02:
+                values[columns.index('Humidity')] = ''
+            if rnd.random() < 0.02:
+                values[columns.index('WindDirection')] = 'Variable'
+            if rnd.random() < 0.01:
+                values[columns.index('DateUTC')] = 'N/A'
+        rows.append(','.join(values) + ',\n<br>\n')
+    if variant == 'messy':
+        # unsorted rows and duplicate time stamps
+        rnd.shuffle(rows)
+        rows.extend(rows[:3])
+    return header + ''.join(rows)
+
+def synthesize_corpus(corpusdir, days, seed=1):
+    '''
+    write days daily files for a station of every variant to corpusdir
+    '''
+    rnd = random.Random(seed)
+    for idx, variant in enumerate(VARIANTS):
+        stationid = 'IREPLAY%i' % idx
+        stationdir = os.path.join(corpusdir, stationid)
+        os.makedirs(stationdir)
+        for td in range(days):
+            day = datetime(2016, 1, 1) + timedelta(days=td)
+            outputfile = os.path.join(stationdir, stationid + '_' +
+                                      day.strftime('%Y%m%d') + '.txt')
+            with open(outputfile, 'w') as fp:
+                fp.write(daily_payload(variant, day, rnd))
+
+def count_rows(stationdir):
+    '''
+    return the number of lines with data in the daily files of stationdir
+    '''
+    rows = 0
+    for inputfile in glob.glob(os.path.join(stationdir, '*.txt')):
+        with open(inputfile, 'r') as fp:
+            # lines with content except the header
+            rows += max(sum(1 for line in fp if line.strip() and
+                            not line.startswith('<br>')) - 1, 0)
+    return rows
+
+def netcdf_digest(filename):
+    '''
+    return a dictionary with the dtype, shape, attributes and a hash of the
+    values of every variable (in every group) of a netCDF file
+    '''
+    digest = {}
+    ncfile = ncdf(filename, 'r')
+    try:
+        digest['attributes'] = {k: str(ncfile.getncattr(k)) for k in
+                                ncfile.ncattrs() if k not in
+                                VOLATILE_ATTRIBUTES}
+        datasets = [('', ncfile)] + [(name + '/', group) for name, group in
+                                     sorted(ncfile.groups.items())]
+        for prefix, dataset in datasets:
+            for name, variable in dataset.variables.items():
+                variable.set_auto_mask(False)
+                values = variable[:]
+                if variable.dtype is str:
+                    data = '\0'.join(values.ravel())
+                else:
+                    # round away differences in the last bits
+                    data = values.astype('f8').round(6).tobytes()
+                digest[prefix + name] = {
+                    'dtype': str(variable.dtype), 'shape': list(values.shape),
+                    'attributes': {k: str(variable.getncattr(k)) for k in
+                                   variable.ncattrs()},
+                    'sha1': hashlib.sha1(data).hexdigest()}
+    finally:
+        ncfile.close()
+    return digest
+
+def replay(corpusdir, outputdir, chunk=None, qc=False, aggregate=None):
+    '''
+    convert every station directory of corpusdir, return the digest of the
+    output (or the error) and the rows and conversion time per station
+    '''
+    results = {}
+    for stationdir in sorted(glob.glob(os.path.join(corpusdir, '*'))):
+        if not os.path.isdir(stationdir):
+            continue
+        stationid = os.path.basename(stationdir)
+        rows = count_rows(stationdir)
+        start = time.time()
+        try:
+            process_raw_data(stationdir, outputdir, chunk=chunk, qc=qc,
+                             aggregate_periods=aggregate)
+            error = None
+        except Exception as e:
+            error = type(e).__name__ + ': ' + str(e)
+        elapsed = time.time() - start
+        outputfile = os.path.join(outputdir, stationid + '.nc')
+        if error is None and os.path.exists(outputfile):
+            digest = netcdf_digest(outputfile)
+        else:
+            digest = {'error': error or 'no output'}
+        results[stationid] = {'digest': digest, 'rows': rows,
+                              'seconds': elapsed}
+    return results
+
+def compare(results, reference):
+    '''
+    return the stations whose output differs from the reference and the
+    differing variables
+    '''
+    differences = {}
+    for stationid in sorted(set(results) | set(reference)):
+        if stationid not in results or stationid not in reference:
+            differences[stationid] = ['station missing']
+            continue
+        new = results[stationid]['digest']
+        old = reference[stationid]
+        changed = sorted(k for k in set(new) | set(old) if
+                         new.get(k) != old.get(k))
+        if changed:
+            differences[stationid] = changed
+    return differences
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay raw payloads ' +
+                                     'through the converter')
+    parser.add_argument('-c', '--corpus', help='Directory with a directory ' +
+                        'of daily raw files per station (default: ' +
+                        'synthesized)', default=None)
+    parser.add_argument('-d', '--days', type=int, default=60,
+                        help='Days per variant of the synthesized corpus')
+    reference_group = parser.add_mutually_exclusive_group()
+    reference_group.add_argument('--record', help='Write the output digest ' +
+                                 'to this reference file', default=None)
+    reference_group.add_argument('--reference', help='Compare the output ' +
+                                 'with this reference file', default=None)
+    parser.add_argument('--chunk', choices=['day', 'month', 'year'],
+                        default=None, help='Chunked netCDF output')
+    parser.add_argument('--qc', action='store_true',
+                        help='Add quality control flags')
+    parser.add_argument('-a', '--aggregate', choices=['hourly', 'daily'],
+                        nargs='+', default=None, help='Add aggregates')
+    opts = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    try:
+        corpusdir = opts.corpus
+        if corpusdir is None:
+            corpusdir = os.path.join(workdir, 'corpus')
+            synthesize_corpus(corpusdir, opts.days)
+        outputdir = os.path.join(workdir, 'output')
+        os.makedirs(outputdir)
+        # the converter prints progress, keep the report readable
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            results = replay(corpusdir, outputdir, chunk=opts.chunk,
+                             qc=opts.qc, aggregate=opts.aggregate)
+        finally:
+            sys.stdout = stdout
+    finally:
+        shutil.rmtree(workdir)
+    print('%-16s %9s %9s %10s  %s' % ('station', 'rows', 'time (s)',
+                                      'rows/s', 'output'))
+    converted = {}
+    for stationid, result in sorted(results.items()):
+        if 'error' in result['digest']:
+            print('%-16s %9i %9s %10s  %s' % (stationid, result['rows'], '-',
+                                              '-', result['digest']['error']))
+            continue
+        converted[stationid] = result
+        print('%-16s %9i %9.3f %10.0f  %i variables' % (
+            stationid, result['rows'], result['seconds'],
+            result['rows'] / max(result['seconds'], 1e-9),
+            len(result['digest']) - 1))
+    # throughput of the stations that were converted
+    rows = sum(result['rows'] for result in converted.values())
+    seconds = sum(result['seconds'] for result in converted.values())
+    print('%-16s %9i %9.3f %10.0f' % ('total', rows, seconds,
+                                      rows / max(seconds, 1e-9)))
+    digests = {stationid: result['digest'] for stationid, result in
+               results.items()}
+    if opts.record:
+        with open(opts.record, 'w') as fp:
+            json.dump(digests, fp, indent=1, sort_keys=True)
+    elif opts.reference:
+        with open(opts.reference, 'r') as fp:
+            reference = json.load(fp)
+        differences = compare(results, reference)
+        for stationid, changed in sorted(differences.items()):
+            print('DIFFERENT %s: %s' % (stationid, ', '.join(changed)))
+        if differences:
+            sys.exit(1)
+        print('Output equal to ' + opts.reference)
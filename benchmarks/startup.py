@@ -0,0 +1,71 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Benchmark the cold-start time of the download_wunderground
+                command line interface and report which heavy modules are
+                imported by each invocation
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:
+Last Modified:
+License:        Apache 2.0
+Notes:          * Usage: python benchmarks/startup.py [-n REPEAT]
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                      'download_wunderground', 'scripts',
+                      'download_wunderground')
+HEAVY_MODULES = ['numpy', 'netCDF4', 'lxml', 'dateutil']
+INVOCATIONS = [['--help'], ['download', '--help'], ['convert', '--help'],
+               ['stations', '--help'], ['query', '--help'],
+               ['ingest', '--help']]
+# run the script and print the heavy modules that have been imported
+PROBE = ('import sys, runpy; sys.argv = {argv!r}\n'
+         'try:\n'
+         '    runpy.run_path({script!r}, run_name="__main__")\n'
+         'except SystemExit:\n'
+         '    pass\n'
+         'sys.stderr.write(",".join(m for m in {modules!r} '
+         'if m in sys.modules))\n')
+
+def cold_start(command, repeat):
+    '''
+    return the best wall clock time of repeat runs of command
+    '''
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(command, stdout=devnull, stderr=devnull)
+            timings.append(time.time() - start)
+    return min(timings)
+
+def imported_modules(argv):
+    '''
+    return the heavy modules imported by a run of the script with argv
+    '''
+    probe = PROBE.format(argv=[SCRIPT] + argv, script=SCRIPT,
+                         modules=HEAVY_MODULES)
+    process = subprocess.Popen([sys.executable, '-c', probe],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr = process.communicate()[1]
+    return stderr.strip().splitlines()[-1] if stderr.strip() else ''
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark CLI cold start')
+    parser.add_argument('-n', '--repeat', type=int, default=10,
+                        help='Number of runs per invocation')
+    opts = parser.parse_args()
+    # interpreter start-up without the script as reference
+    print('%-22s %7.1f ms' % ('python -c pass', 1000 * cold_start(
+        [sys.executable, '-c', 'pass'], opts.repeat)))
+    for argv in INVOCATIONS:
+        print('%-22s %7.1f ms  imports: %s' % (
+            ' '.join(argv), 1000 * cold_start([sys.executable, SCRIPT] + argv,
+                                              opts.repeat),
+            imported_modules(argv) or '-'))
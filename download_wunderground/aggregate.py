@@ -0,0 +1,73 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Vectorized aggregation of irregular station time series to
+                regular (hourly/daily) intervals:
+                    * time_bins(epochs, seconds)
+                    * aggregate_column(values, starts)
+                    * wind_vector_mean(speed, direction, starts)
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:
+Last Modified:
+License:        Apache 2.0
+Notes:          * The time axis must be sorted, every interval is a
+                  contiguous slice of samples
+                * Missing values are nan and are ignored
+'''
+
+from numpy import add as npadd
+from numpy import arctan2
+from numpy import concatenate as npconcatenate
+from numpy import degrees
+from numpy import errstate
+from numpy import flatnonzero
+from numpy import fmax
+from numpy import fmin
+from numpy import hypot
+from numpy import isnan
+from numpy import nan as npnan
+from numpy import where
+from numpy import zeros
+import download_wunderground.utils as utils
+
+# length of the aggregation intervals in seconds
+AGGREGATE_PERIODS = {'hourly': 3600, 'daily': 86400}
+
+def time_bins(epochs, seconds):
+    '''
+    return the start time (epoch seconds) of every interval of the given
+    length that contains samples, and the index of the first sample of each
+    interval
+    '''
+    bins = epochs // seconds
+    if len(bins) == 0:
+        return bins, zeros(0, dtype=int)
+    starts = npconcatenate(([0], flatnonzero(bins[1:] != bins[:-1]) + 1))
+    return bins[starts] * seconds, starts
+
+def aggregate_column(values, starts):
+    '''
+    return the mean, minimum, maximum and number of valid samples of values
+    in each interval defined by the start indices starts
+    '''
+    valid = ~isnan(values)
+    count = npadd.reduceat(valid.astype(int), starts)
+    total = npadd.reduceat(where(valid, values, 0.), starts)
+    with errstate(invalid='ignore', divide='ignore'):
+        mean = where(count > 0, total / count, npnan)
+    # fmin/fmax ignore nan unless all values in an interval are nan
+    minimum = fmin.reduceat(values, starts)
+    maximum = fmax.reduceat(values, starts)
+    return mean, minimum, maximum, count
+
+def wind_vector_mean(speed, direction, starts):
+    '''
+    return the vector averaged wind speed and direction (degrees, direction
+    the wind is coming from) in each interval defined by starts
+    '''
+    U, V = utils.wind_components(speed, direction)
+    meanU = aggregate_column(U, starts)[0]
+    meanV = aggregate_column(V, starts)[0]
+    meanSpeed = hypot(meanU, meanV)
+    meanDirection = degrees(arctan2(-meanU, -meanV)) % 360.
+    return meanSpeed, meanDirection
@@ -0,0 +1,269 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Archive the downloaded raw csv files of a station:
+                    * tar.gz: single-threaded gzip (python tarfile)
+                    * pigz: tar stream compressed by parallel pigz
+                    * zstd: tar stream compressed by multi-threaded zstd
+                    * log: append-only gzip log per station
+                Archiving runs in a background process, so it overlaps the
+                download of the next station.
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:
+Last Modified:
+License:        Apache 2.0
+Notes:          * pigz/zstd need the pigz/zstd executable or, for zstd,
+                  the optional zstandard python package
+                * Archives are written to a temporary file that replaces the
+                  archive only when it is complete
+                * The log only appends days that are new or changed since
+                  they were logged, a changed day is logged again and its
+                  last copy is the current one
+'''
+
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+from distutils.spawn import find_executable
+from multiprocessing import Process, Queue, cpu_count
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_METHODS = ['tar.gz', 'pigz', 'zstd', 'log', 'none']
+# file extension of the archive for each method
+ARCHIVE_EXTENSIONS = {'tar.gz': '.tar.gz', 'pigz': '.tar.gz',
+                      'zstd': '.tar.zst', 'log': '.log.gz'}
+
+logger = logging.getLogger()
+
+class archive_raw_data:
+    '''
+    Archive (and remove) station directories with raw csv files in a
+    background process. A process is used instead of a thread because the
+    download pools are forked while archiving is in progress.
+    '''
+    def __init__(self, outputdir, method='tar.gz', background=True,
+                 remove=True, threads=None):
+        if method not in ARCHIVE_METHODS:
+            raise ValueError('Unknown archive method: ' + str(method))
+        self.outputdir = outputdir
+        self.method = method
+        self.remove = remove
+        self.threads = threads or cpu_count()
+        if method in ['pigz', 'zstd'] and compressor_command(
+                method, self.threads) is None:
+            if method == 'pigz' or zstandard is None:
+                raise IOError(method + ' is not installed')
+        self.queue = None
+        if background:
+            # single worker, stations are archived in order while the
+            # compression itself is parallel for pigz/zstd
+            self.queue = Queue()
+            self.errors = Queue()
+            self.worker = Process(target=self.run)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def submit(self, inputdir, stationid):
+        '''
+        archive inputdir containing the raw files of stationid
+        '''
+        if self.queue is None:
+            self.archive(inputdir, stationid)
+        else:
+            self.queue.put((inputdir, stationid))
+
+    def join(self):
+        '''
+        wait until all submitted stations are archived, raise an IOError
+        if archiving failed in the background process
+        '''
+        if self.queue is None:
+            return
+        self.queue.put(None)
+        failed = self.errors.get()
+        self.worker.join()
+        self.queue = None
+        if failed:
+            raise IOError('Archiving failed for: ' + ', '.join(failed))
+
+    def run(self):
+        '''
+        background process archiving the submitted stations
+        '''
+        failed = []
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.archive(*item)
+            except Exception as e:
+                logger.error('Archiving ' + item[1] + ' failed: ' + str(e))
+                failed.append(item[1])
+        self.errors.put(failed)
+
+    def archive(self, inputdir, stationid):
+        '''
+        archive inputdir with the configured method and remove it afterwards
+        '''
+        if self.method != 'none':
+            outputfile = os.path.join(self.outputdir, stationid +
+                                      ARCHIVE_EXTENSIONS[self.method])
+            logger.info('Archive ' + inputdir + ' to ' + outputfile)
+            if self.method == 'log':
+                write_raw_log(inputdir, outputfile)
+            else:
+                # a failed archive must not leave a truncated file behind
+                tmpfile = outputfile + '.tmp'
+                try:
+                    if self.method == 'tar.gz':
+                        tar = tarfile.open(tmpfile, 'w:gz')
+                        tar.add(inputdir, arcname=stationid)
+                        tar.close()
+                    else:
+                        write_compressed_tar(inputdir, stationid, tmpfile,
+                                             self.method, self.threads)
+                except:
+                    if os.path.exists(tmpfile):
+                        os.remove(tmpfile)
+                    raise
+                os.rename(tmpfile, outputfile)
+        if self.remove:
+            # remove csv files
+            shutil.rmtree(inputdir)
+
+def write_compressed_tar(inputdir, stationid, outputfile, method, threads):
+    '''
+    stream a tar of inputdir through a parallel compressor (pigz or zstd)
+    into outputfile, paths in the tar are relative to stationid
+    '''
+    with open(outputfile, 'wb') as outfile:
+        if method == 'zstd' and zstandard is not None:
+            compressor = zstandard.ZstdCompressor(threads=threads)
+            with compressor.stream_writer(outfile) as writer:
+                tar = tarfile.open(fileobj=writer, mode='w|')
+                tar.add(inputdir, arcname=stationid)
+                tar.close()
+            return
+        process = subprocess.Popen(compressor_command(method, threads),
+                                   stdin=subprocess.PIPE,
+                                   stdout=outfile)
+        try:
+            tar = tarfile.open(fileobj=process.stdin, mode='w|')
+            tar.add(inputdir, arcname=stationid)
+            tar.close()
+        finally:
+            process.stdin.close()
+            returncode = process.wait()
+        if returncode != 0:
+            raise IOError(method + ' failed for ' + outputfile)
+
+def compressor_command(method, threads):
+    '''
+    return the command line of the parallel compressor for method, or None
+    if the executable is not installed
+    '''
+    executable = find_executable(method)
+    if executable is None:
+        return None
+    if method == 'zstd':
+        return [executable, '-q', '-T' + str(threads)]
+    return [executable, '-p', str(threads)]
+
+def log_index_filename(outputfile):
+    '''
+    return the file with the index of the days in the log outputfile
+    '''
+    directory, filename = os.path.split(outputfile)
+    return os.path.join(directory, '.' + filename + '.json')
+
+def read_log_index(outputfile):
+    '''
+    return the sha1 of the last logged copy of every day in the log
+    outputfile, the log is scanned if its index file is missing
+    '''
+    try:
+        with open(log_index_filename(outputfile), 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        pass
+    index = {}
+    if not os.path.exists(outputfile):
+        return index
+    log = gzip.open(outputfile, 'rb')
+    try:
+        for filename, content in iter_raw_log(log):
+            index[filename] = hashlib.sha1(content).hexdigest()
+    finally:
+        log.close()
+    return index
+
+def iter_raw_log(log):
+    '''
+    yield the (filename, content) of every day in an opened raw log, see
+    write_raw_log for the format
+    '''
+    while True:
+        marker = log.readline()
+        if not marker:
+            return
+        if not marker.startswith('### '):
+            raise IOError('Invalid record in raw log: ' + marker[:80])
+        filename, size = marker[4:].rstrip('\n').rsplit(' ', 1)
+        content = log.read(int(size))
+        if len(content) != int(size):
+            raise IOError('Truncated record in raw log: ' + filename)
+        if not content.endswith('\n'):
+            # newline that ends the record
+            log.read(1)
+        yield filename, content
+
+def write_raw_log(inputdir, outputfile, filelist=None):
+    '''
+    append the daily raw files in inputdir (or in filelist) that are new or
+    changed since they were logged to the gzip log outputfile. Each day is preceded by a
+    line "### <filename> <size in bytes>" and followed by a newline if its
+    content does not end with one. Every call appends a new gzip member,
+    which gzip readers read as one continuous stream. The sha1 of the
+    logged days is kept in an index file next to the log.
+    '''
+    index = read_log_index(outputfile)
+    if filelist is None:
+        filelist = sorted(glob.glob(os.path.join(inputdir, '*.txt')))
+    days = []
+    for inputfile in filelist:
+        with open(inputfile, 'rb') as infile:
+            content = infile.read()
+        digest = hashlib.sha1(content).hexdigest()
+        if index.get(os.path.basename(inputfile)) != digest:
+            days.append((os.path.basename(inputfile), content, digest))
+    if not days and os.path.exists(log_index_filename(outputfile)):
+        return
+    if days:
+        log = gzip.open(outputfile, 'ab')
+        try:
+            for filename, content, digest in days:
+                log.write('### ' + filename + ' ' + str(len(content)) +
+                          '\n')
+                log.write(content)
+                if not content.endswith('\n'):
+                    log.write('\n')
+        finally:
+            log.close()
+    # the index is written after the days are logged, or after it was
+    # rebuilt from the log
+    index.update((filename, digest) for filename, content, digest in days)
+    tmpfile = log_index_filename(outputfile) + '.tmp'
+    with open(tmpfile, 'w') as fp:
+        json.dump(index, fp, indent=1, sort_keys=True)
+    os.rename(tmpfile, log_index_filename(outputfile))
@@ -17,26 +17,47 @@ import csv
 import glob
 import os
 from netCDF4 import Dataset as ncdf
-from netCDF4 import date2num as ncdf_date2num
 from datetime import datetime
-from numpy import zeros
-from numpy import argsort
+import calendar
+from numpy import arange
 from numpy import array as nparray
 from numpy import append as npappend
+from numpy import diff as npdiff
+from numpy import full
+from numpy import zeros
+from numpy import where
+from numpy import isnan
+from numpy import searchsorted
 import time
-from dateutil import tz
 import argparse
 import itertools
 from numpy import nan as npnan
 from numpy import concatenate as npconcatenate
 import download_wunderground.utils as utils
+import download_wunderground.quality_control as quality_control
+import download_wunderground.aggregate as aggregate
+import download_wunderground.fields as fields
+
+# number of characters of the YYYYMMDD date in the input filenames that
+# define a chunk for the chunked netCDF writer
+CHUNK_LENGTHS = {'day': 8, 'month': 6, 'year': 4}
+# reference time (epoch seconds) of the netCDF time axis
+TIME_REFERENCE = calendar.timegm((2010, 1, 1, 0, 0, 0))
+# missing values in the Wunderground data and the netCDF file
+FILL_VALUE = fields.FILL_VALUE
+# netCDF variables with a special treatment in the aggregates
+WIND_SPEED = 'wind_speed'
+WIND_DIRECTION = 'WindDirectionDegrees'
+PRECIPITATION = 'HourlyPrecipMM'
 
 class process_raw_data:
     ''''
     Class to read the raw input data and combine them into a single output
     file
     '''
-    def __init__(self, inputdir, outputdir, lat=False, lon=False):
+    def __init__(self, inputdir, outputdir, lat=False, lon=False,
+                 chunk=None, qc=False, aggregate_periods=None,
+                 metadata=None):
         # set class variables
         self.inputdir = inputdir
         print('Processing ' + self.inputdir)
@@ -46,6 +67,22 @@ class process_raw_data:
         self.outputfile = os.path.join(self.outputdir, filename)
         self.lat = lat
         self.lon = lon
+        # write netCDF file in slabs of a day/month/year instead of at once
+        if chunk and chunk not in CHUNK_LENGTHS:
+            raise ValueError('Unknown chunk size: ' + str(chunk))
+        self.chunk = chunk
+        # add quality control flags to the netCDF file
+        self.qc = qc
+        # write hourly/daily aggregates in netCDF groups
+        self.aggregate_periods = aggregate_periods or []
+        for period in self.aggregate_periods:
+            if period not in aggregate.AGGREGATE_PERIODS:
+                raise ValueError('Unknown aggregation period: ' + str(period))
+        # samples of incomplete intervals held back between slabs
+        self.aggregate_carry = {}
+        # samples at the end of the previous slab checked again by the
+        # quality control of the next slab
+        self.qc_carry = None
         if os.path.exists(os.path.join(self.outputfile)):
             # check if filesize is not null
             if os.path.getsize(os.path.join(self.outputfile)) > 0:
@@ -56,233 +93,553 @@ class process_raw_data:
         # do we want to hardcode this?
         self.get_field_names()
         try:
-          self.dateUTCstring = [s for s in self.field_names if s is not None
-                                and "DateUTC" in s][0]
-          #self.field_names.append('<br>')
-          # call functions
-          self.combine_raw_data()
-          self.write_combined_data_netcdf()
-        except AttributeError:
+          self.dateUTCstring = [s for s in self.field_names if
+                                "DateUTC" in s][0]
+        except IndexError:
+          # no file with a header with UTC time
           print('Nothing to write for ' + self.outputfile)
+          return
+        if not (lat and lon) and metadata is not None:
+            # location from the station metadata cache, only looked up for
+            # a file that is written
+            self.lat, self.lon = metadata.location(
+                os.path.basename(self.inputdir))
+        # call functions
+        if self.chunk:
+            self.write_chunked_data_netcdf()
+        else:
+            self.combine_raw_data()
+            if len(self.time) > 0:
+                self.write_combined_data_netcdf()
+            else:
+                print('Nothing to write for ' + self.outputfile)
 
-    def combine_raw_data(self):
+    def combine_raw_data(self, filelist=None, after=None):
         '''
         combine them
         into single output variable
+        filelist optionally limits the input to a subset of the txt files,
+        after (epoch seconds) optionally skips the older rows
+        The UTC time axis is stored as integer epoch seconds in self.time,
+        the other columns are stored as typed numpy arrays in self.data
+        '''
+        if filelist is None:
+            # get a list of all txt files in inputdir, sorted by filename
+            filelist = sorted(glob.glob(os.path.join(self.inputdir, '*.txt')))
+        if len(filelist) == 0:
+            raise IOError('No files found in ' + self.inputdir)
+        # read the daily files, each of them sorted by time
+        days = [self.read_raw_file(inputfile, after) for inputfile in
+                filelist]
+        days = [(epochs, columns) for epochs, columns in days if len(epochs)]
+        self.time = npconcatenate([epochs for epochs, columns in days] +
+                                  [zeros(0, dtype='int64')])
+        # indices that order the concatenated days, None if already ordered
+        order = self.order_data(self.time)
+        if order is not None:
+            self.time = self.time[order]
+        field_names = set()
+        for epochs, columns in days:
+            field_names.update(columns.keys())
+        self.data = {}
+        for field_name in field_names:
+            # fill columns that are missing in a daily file with ''
+            column = npconcatenate([columns[field_name] if field_name in
+                                    columns else full(len(epochs), '',
+                                                      dtype=object)
+                                    for epochs, columns in days])
+            if order is not None:
+                column = column[order]
+            self.data[field_name] = utils.typed_column(column)
+
+    def read_raw_file(self, inputfile, after=None):
+        '''
+        read a single daily csv file, return the UTC time axis (epoch
+        seconds) and a dictionary with a string column for each field,
+        both sorted by time. Rows before after (epoch seconds) are skipped
+        before the columns are built.
+        '''
+        dateUTCstring = self.dateUTCstring
+        with open(inputfile, 'r') as csvin:
+            reader = csv.reader(csvin, delimiter=',')
+            header = self.read_header(reader)
+            rows = [row for row in reader if row]
+        if header is None:
+            return zeros(0, dtype='int64'), {}
+        # column index of every field, a repeated field name uses the last
+        # column with that name
+        indices = dict((k, idx) for idx, k in enumerate(header))
+        if dateUTCstring not in indices:
+            return zeros(0, dtype='int64'), {}
+        idx_utc = indices.pop(dateUTCstring)
+        # skip lines with the <br> separator or without UTC time
+        idx_time = indices.get('Time')
+        rows = [row for row in rows if len(row) > idx_utc and
+                (idx_time is None or idx_time >= len(row) or
+                 row[idx_time] != '<br>')]
+        epochs, valid = self.parse_utc([row[idx_utc].strip() for row in
+                                        rows])
+        if valid is not None:
+            # Not a valid csv line, so skip
+            rows = [row for row, ok in zip(rows, valid) if ok]
+        if after is not None:
+            new = epochs >= after
+            if not new.all():
+                rows = [row for row, ok in zip(rows, new) if ok]
+                epochs = epochs[new]
+        # add empty values for rows that missed fields at the end
+        length = len(header)
+        rows = [row if len(row) >= length else
+                row + [''] * (length - len(row)) for row in rows]
+        values = zip(*rows) if rows else [()] * length
+        columns = {k: nparray([v.strip() for v in values[idx]],
+                              dtype=object) for k, idx in indices.items()}
+        if len(epochs) and not (npdiff(epochs) >= 0).all():
+            # stable sort of the day according to time
+            idx_sort = epochs.argsort(kind='mergesort')
+            epochs = epochs[idx_sort]
+            columns = {k: v[idx_sort] for k, v in columns.items()}
+        return epochs, columns
+
+    def parse_utc(self, datestrings):
+        '''
+        return the epoch seconds of a list of UTC time strings (YYYY-mm-dd
+        HH:MM:SS) and a list with the valid strings, None if all are valid.
+        Well-formed lists are parsed by numpy at once, otherwise every
+        string is parsed by strptime and invalid strings are left out.
+        '''
+        if all(len(d) == 19 and d[4] == '-' and d[7] == '-' and
+               d[10] == ' ' and d[13] == ':' and d[16] == ':' for d in
+               datestrings):
+            try:
+                return nparray(datestrings, dtype='datetime64[s]').astype(
+                    'int64'), None
+            except ValueError:
+                pass
+        epochs = []
+        valid = []
+        for datestring in datestrings:
+            try:
+                timeObject = datetime.strptime(datestring,
+                                               '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                valid.append(False)
+                continue
+            valid.append(True)
+            epochs.append(calendar.timegm(timeObject.timetuple()))
+        return nparray(epochs, dtype='int64'), valid
+
+    def order_data(self, epochs):
+        '''
+        Return the indices that sort the time axis and remove duplicate
+        time stamps (the last occurrence is kept), or None if the time axis
+        is strictly increasing already. The daily files are sorted
+        individually, so the stable sort only has to merge the sorted runs.
+        '''
+        steps = npdiff(epochs)
+        if (steps > 0).all():
+            return None
+        if (steps >= 0).all():
+            order = arange(len(epochs))
+        else:
+            order = epochs.argsort(kind='mergesort')
+        epochs = epochs[order]
+        # keep the last sample of each group of duplicate time stamps
+        keep = npappend(epochs[1:] != epochs[:-1], True)
+        return order[keep]
+
+    def write_combined_data_netcdf(self):
+        '''
+        Write the combined data in self.data to the netCDF output file in a
+        single slab
+        '''
+        self.create_netcdf_file()
+        self.write_netcdf_slab()
+        self.ncfile.close()
+
+    def write_chunked_data_netcdf(self):
+        '''
+        Write the netCDF output file chunk by chunk. The daily input files
+        are grouped per self.chunk (day/month/year), each group is combined
+        and appended as a slab along the unlimited time dimension and
+        released afterwards, so memory use is bounded by the chunk size
+        instead of the length of the station history.
         '''
-        # get a list of all txt files in inputdir, sorted by filename
         filelist = sorted(glob.glob(os.path.join(self.inputdir, '*.txt')))
         if len(filelist) == 0:
             raise IOError('No files found in ' + self.inputdir)
-        for inputfile in filelist:
-            with open(inputfile, 'r') as csvin:
-                reader = csv.DictReader(csvin, delimiter=',')
+        self.create_netcdf_file()
+        try:
+            for key, chunkfiles in itertools.groupby(filelist,
+                                                      self.chunk_key):
                 try:
-                    self.data
+                    del self.data
                 except AttributeError:
-                    #reader.next()
-                    try:
-                        self.data = {k.strip(): [utils.fitem(v)] for k, v in
-                                     reader.next().items() if k is not None}
-                    except StopIteration:
-                        pass
-                current_row = 0
-                for line in reader:
-                    current_row += 1
-                    if current_row == 1:  # header
-                        # skip the header
-                        continue
-                    elif line['Time'] == '<br>':
-                        # not a valid csv line, so skip
-                        continue
-                    else:
-                        try:
-                            datetime.strptime(line[self.dateUTCstring],
-                                              ('%Y-%m-%d %H:%M:%S'))
-                        except ValueError:
-                            # Not a valid csv line, so skip
-                            continue
-                    lenDateUTC = len(self.data['DateUTC'])
-                    for k, v in line.items():
-                        if k is not None and k in self.data.keys():  # skip over empty fields
-                            k = k.strip()
-                            try:
-                                addnones = lenDateUTC - len(self.data[k])
-                            except NameError:
-                                addnones = 0
-                            if addnones > 0:
-                                toadd = ['' for c in range(0,addnones)]
-                                self.data[k] = npconcatenate((
-                                    self.data[k], toadd)).tolist()
-                            self.data[k].append(utils.fitem(v))
-        # check if we need to add empty values at the end of the lists
-        lenDateUTC = len(self.data['DateUTC'])
-        for var in self.data.keys():
-            try:
-                addnones = lenDateUTC - len(self.data[var])
-            except NameError:
-                addnones = 0
-            if addnones > 0:
-                toadd = ['' for c in range(0,addnones)]
-                self.data[var] = npconcatenate((
-                    self.data[var], toadd)).tolist()         
-        # verify that everything is sorted with time
-        if not self.verify_sorting():
-            # sort data if needed according to time
-            self.sort_data()
+                    pass
+                self.combine_raw_data(list(chunkfiles))
+                self.write_netcdf_slab()
+                # flush slab to disk before reading the next chunk
+                self.ncfile.sync()
+            # aggregate the samples of the last interval
+            self.write_aggregates(zeros(0, dtype='int64'), {}, final=True)
+        finally:
+            self.ncfile.close()
 
-    def write_combined_data_netcdf(self):
-        ncfile = ncdf(self.outputfile, 'w', format='NETCDF4')
+    def chunk_key(self, inputfile):
+        '''
+        return the chunk a daily input file belongs to, input files are
+        named <stationid>_YYYYMMDD.txt
+        '''
+        datestring = os.path.splitext(os.path.basename(inputfile))[0][-8:]
+        return datestring[:CHUNK_LENGTHS[self.chunk]]
+
+    def create_netcdf_file(self):
+        '''
+        Create the netCDF output file with an unlimited time dimension and
+        the (optional) station location
+        '''
+        self.ncfile = ncdf(self.outputfile, 'w', format='NETCDF4')
         # description of the file
-        ncfile.description = 'Hobby meteorologists data ' + self.inputdir
-        ncfile.history = 'Created ' + time.ctime(time.time())
+        self.ncfile.description = 'Hobby meteorologists data ' + self.inputdir
+        self.ncfile.history = 'Created ' + time.ctime(time.time())
         # create time dimension
-        timevar = ncfile.createDimension('time', None)
-        # create time variable local time Europe/Amsterdam
-        timeaxisLocal = zeros(len(self.data[self.dateUTCstring][1:]))
-        # define UTC and local time-zone (hardcoded)
-        from_zone = tz.gettz('UTC')
-        to_zone = tz.gettz('Europe/Amsterdam')
-        # convert time string to datetime object
-        for idx in range(1, len(self.data[self.dateUTCstring])):
-            # define time object from string
-            timeObject = datetime.strptime(self.data[self.dateUTCstring][idx],
-                                           '%Y-%m-%d %H:%M:%S')
-            # tell timeObject that it is in UTC
-            timeObject = timeObject.replace(tzinfo=from_zone)
-            # time axis UTC
-            try:
-              timeaxis = npappend(timeaxis, ncdf_date2num(
-                timeObject.replace(tzinfo=None),
-                units='minutes since 2010-01-01 00:00:00',
-                calendar='gregorian'))
-            except NameError:
-              timeaxis = ncdf_date2num(
-                timeObject.replace(tzinfo=None),
-                units='minutes since 2010-01-01 00:00:00',
-                calendar='gregorian')
-
+        self.ncfile.createDimension('time', None)
         # netcdf time variable UTC
-        timevar = ncfile.createVariable('time', 'i4', ('time',),
-                                        zlib=True)
-        timevar[:] = timeaxis
+        timevar = self.ncfile.createVariable('time', 'i4', ('time',),
+                                             zlib=True)
         timevar.units = 'minutes since 2010-01-01 00:00:00'
         timevar.calendar = 'gregorian'
         timevar.standard_name = 'time'
         timevar.long_name = 'time in UTC'
-
         # write lon/lat variables if available
         if ((self.lat) and (self.lon)):
-            lonvar = ncfile.createDimension('longitude', 1)
-            lonvar = ncfile.createVariable('longitude', 'float32',('longitude',))
+            self.ncfile.createDimension('longitude', 1)
+            lonvar = self.ncfile.createVariable('longitude', 'float32',
+                                                ('longitude',))
             lonvar.units = 'degrees_east'
             lonvar.axis = 'X'
             lonvar.standard_name = 'longitude'
             lonvar[:] = self.lon
-            latvar = ncfile.createDimension('latitude', 1)
-            latvar = ncfile.createVariable('latitude', 'float32',('latitude',))
+            self.ncfile.createDimension('latitude', 1)
+            latvar = self.ncfile.createVariable('latitude', 'float32',
+                                                ('latitude',))
             latvar.units = 'degrees_north'
             latvar.axis = 'Y'
             latvar.standard_name = 'latitude'
             latvar[:] = self.lat
-        # create other variables in netcdf file
-        for self.variable in self.data.keys():
-            if self.variable not in [self.dateUTCstring, 'Time', '<br>', None]:
-                # add variables in netcdf file
-                # convert strings to npnan if array contains numbers
-                if True in [utils.is_number(c)
-                            for c in self.data[self.variable]]:
-                    self.data[self.variable] = [npnan if isinstance(
-                        utils.fitem(c), str) else utils.fitem(c) for c in self.data[
-                            self.variable]]
-                # check if variable is a string
-                if not isinstance(self.data[self.variable][1], str):
-                    # fill variable
-                    if self.variable == 'SolarRadiationWatts/m^2':
-                        #variableName = 'SolarRadiation'
-                        continue
-                    elif ((self.variable == 'TemperatureC') or
-                          (self.variable == 'TemperatureF')):
-                        variableName = 'temperature'
-                    else:
-                        variableName = self.variable
-                    self.values = ncfile.createVariable(
-                        variableName, type(self.data[self.variable][1]),
-                        ('time',), zlib=True, fill_value=-999)
+
+    def write_netcdf_slab(self):
+        '''
+        Append the data in self.data to the netCDF output file along the
+        time dimension, variables are created when they are first seen
+        '''
+        ncfile = self.ncfile
+        timevar = ncfile.variables['time']
+        start = len(ncfile.dimensions['time'])
+        end = start + len(self.time)
+        if end == start:
+            return
+        # convert epoch seconds (UTC) to minutes since TIME_REFERENCE
+        timevar[start:end] = (self.time - TIME_REFERENCE) // 60
+        if self.qc:
+            # quality control flags for each checked raw field
+            flags = self.slab_qc_flags(start, end)
+        else:
+            flags = {}
+        # converted numeric columns (missing values are nan) to aggregate
+        converted = {}
+        # converted columns of numeric raw fields to derive variables from
+        numeric_variables = {}
+        # create/fill other variables in netcdf file, the field registry
+        # defines the variable, attributes and unit conversion of a field
+        for field_name, definition in fields.compile_fields(self.data.keys()):
+            variableName = definition['name']
+            column = self.data[field_name]
+            numeric = column.dtype != object
+            if variableName in ncfile.variables:
+                ncvar = ncfile.variables[variableName]
+            else:
+                if definition['dtype'] is None:
+                    # unknown field, the type follows the column
+                    dtype = 'f8' if numeric else str
                 else:
+                    dtype = definition['dtype']
+                if dtype is str:
                     # string variables cannot have fill_value
-                    self.values = ncfile.createVariable(
-                        self.variable, type(self.data[self.variable][1]),
-                        ('time',), zlib=True)
-                # TODO: km/h->m/s ??
-                try:  # fill variable
-                    if not self.variable in ['TemperatureC', 'TemperatureF']:
-                      self.values[:] = self.data[self.variable][1:]
-                    elif self.variable == 'TemperatureC':
-                      self.values[:] = 273.15 + nparray(self.data[self.variable][1:])
-                    elif self.variable == 'TemperatureF':
-                      self.values[:] = (nparray(self.data[self.variable][1:]) - 32.)/1.8
-                except IndexError:
-                    # for strings the syntax is slightly different
-                    self.values = self.data[self.variable][1:]
-                self.fill_attribute_data()
-        ncfile.close()
+                    ncvar = ncfile.createVariable(
+                        variableName, str, ('time',), zlib=True)
+                else:
+                    ncvar = ncfile.createVariable(
+                        variableName, dtype, ('time',), zlib=True,
+                        fill_value=definition['fill_value'])
+                for attribute, value in definition['attributes'].items():
+                    ncvar.setncattr(attribute, value)
+            # a column can have a different type in another chunk
+            if ncvar.dtype is str:
+                if numeric:
+                    column = column.astype(str).astype(object)
+                ncvar[start:end] = column
+            else:
+                if numeric:
+                    column = self.missing_to_nan(column)
+                    if definition['convert'] is not None:
+                        column = definition['convert'](column)
+                    numeric_variables[variableName] = column
+                else:
+                    column = full(len(column), npnan)
+                converted[variableName] = column
+                # store missing values as fill value
+                ncvar[start:end] = where(isnan(column),
+                                         definition['fill_value'], column)
+            if field_name in flags:
+                flagStart, flag = flags[field_name]
+                self.write_qc_flags(variableName, flag, flagStart, end)
 
-    def fill_attribute_data(self):
-        '''
-        Function that fills the attribute data of the netcdf file
-        '''
-        if self.variable == 'TemperatureC':
-            self.values.units = 'K'
-            self.values.standard_name = 'air_temperature'
-            self.values.long_name = 'air temperature'
-        elif self.variable == 'TemperatureF':
-            self.values.units = 'K'
-            self.values.standard_name = 'air_temperature'
-            self.values.long_name = 'air temperature'
-        elif self.variable == 'DewpointC':
-            self.values.units = 'C'
-            self.values.standard_name = 'dew_point_temperature'
-            self.values.long_name = 'dewpoint temperature'
-        elif self.variable == 'PressurehPa':
-            self.values.units = 'hPa'
-            self.values.long_name = 'surface pressure'
-            self.values.standard_name = 'surface_air_pressure'
-        elif self.variable == 'PressureIn':
-            pass
-        elif self.variable == 'WindDirection':
-            pass
-        elif self.variable == 'WindDirectionDegrees':
-            self.values.units = 'degrees'
-            pass
-        elif self.variable == 'WindSpeedKMH':
-            self.values.units = 'km/h'
-            self.values.standard_name = 'wind_speed'
-            self.values.long_name = 'wind speed'
-        elif self.variable == 'WindSpeedGustKMH':
-            self.values.units = 'km/h'
-            self.values.standard_name = 'wind_speed_of_gust'
-            self.values.long_name = 'gust wind speed'
-        elif self.variable == 'Humidity':
-            self.values = ''
-        elif self.variable == 'HourlyPrecipMM':
-            self.values.units = 'mm/h'
-            self.values.long_name = 'hourly precipitation'
-        elif self.variable == 'Conditions':
-            pass
-        elif self.variable == 'Clouds':
-            pass
-        elif self.variable == 'dailyrainMM':
-            self.values.units = 'mm/day'
-            self.values.long_name = 'daily precipitation'
-        elif self.variable == 'SoftwareType':
-            pass
-        elif self.variable == 'SolarRadiationWatts/m^2':
-            self.values.units = 'Watts/m2'
-            self.values.long_name = 'solar radiation'
-        else:
-            pass
-            #raise Exception('Unkown field name ' + self.variable)
+        # wind speed/gust in m/s and wind components
+        wind = self.derive_wind(numeric_variables)
+        for variableName, column in wind.items():
+            if variableName in fields.DERIVED_FIELDS:
+                self.write_derived_variable(variableName, column, start, end)
+                converted[variableName] = column
+        if WIND_DIRECTION in wind:
+            # aggregate the cleaned wind direction
+            converted[WIND_DIRECTION] = wind[WIND_DIRECTION]
+        if self.aggregate_periods:
+            self.write_aggregates(self.time, converted,
+                                  final=not self.chunk)
+
+    def derive_wind(self, numeric_variables):
+        '''
+        Derive the wind speed and gust in m/s and the eastward/northward
+        wind components. The wind speed and gust are converted by
+        fields.DERIVED_FIELDS from their variable in numeric_variables, the
+        direction is taken from the raw columns in self.data. Calm (zero
+        wind speed) gives zero wind components, a variable or invalid wind
+        direction gives missing (nan) wind components.
+        '''
+        wind = {}
+        for variableName, definition in fields.DERIVED_FIELDS.items():
+            if definition['source'] in numeric_variables:
+                wind[variableName] = definition['convert'](
+                    numeric_variables[definition['source']])
+        if ('wind_speed' not in wind or
+                not self.numeric_column('WindDirectionDegrees')):
+            return wind
+        direction = self.missing_to_nan(self.data['WindDirectionDegrees'])
+        invalid = ~((direction >= 0) & (direction <= 360))
+        if 'WindDirection' in self.data:
+            # variable wind direction has no valid direction in degrees
+            invalid |= self.data['WindDirection'] == 'Variable'
+        direction = where(invalid, npnan, direction)
+        speed = wind['wind_speed']
+        # calm wind has no direction but zero wind components
+        U, V = utils.wind_components(speed, where(speed == 0, 0., direction))
+        wind['eastward_wind'] = U
+        wind['northward_wind'] = V
+        wind[WIND_DIRECTION] = direction
+        return wind
+
+    def numeric_column(self, field_name):
+        '''
+        return True if field_name is a numeric column in self.data
+        '''
+        return (field_name in self.data and
+                self.data[field_name].dtype != object)
+
+    def missing_to_nan(self, column):
+        '''
+        return column with missing values replaced by nan
+        '''
+        return where(column == FILL_VALUE, npnan, column)
+
+    def write_derived_variable(self, variableName, column, start, end):
+        '''
+        Write a variable derived during conversion to the netCDF file, the
+        attributes are defined in fields.DERIVED_FIELDS
+        '''
+        if variableName not in self.ncfile.variables:
+            ncvar = self.ncfile.createVariable(
+                variableName, 'f8', ('time',), zlib=True,
+                fill_value=FILL_VALUE)
+            definition = fields.DERIVED_FIELDS[variableName]
+            for attribute, value in definition['attributes'].items():
+                ncvar.setncattr(attribute, value)
+        self.ncfile.variables[variableName][start:end] = where(
+            isnan(column), FILL_VALUE, column)
+
+    def write_aggregates(self, epochs, columns, final=False):
+        '''
+        Append the aggregates of the converted columns to a netCDF group for
+        each period in self.aggregate_periods. Unless final is True the
+        samples of the last (possibly incomplete) interval are held back
+        and aggregated together with the next slab.
+        '''
+        for period in self.aggregate_periods:
+            seconds = aggregate.AGGREGATE_PERIODS[period]
+            periodEpochs = epochs
+            periodColumns = columns
+            if period in self.aggregate_carry:
+                carryEpochs, carryColumns = self.aggregate_carry.pop(period)
+                periodEpochs = npconcatenate((carryEpochs, epochs))
+                periodColumns = {}
+                for name in set(carryColumns.keys()) | set(columns.keys()):
+                    periodColumns[name] = npconcatenate((
+                        carryColumns.get(name, full(len(carryEpochs), npnan)),
+                        columns.get(name, full(len(epochs), npnan))))
+            if not final and len(periodEpochs):
+                # first sample in the last interval
+                split = searchsorted(periodEpochs, periodEpochs[-1] -
+                                     periodEpochs[-1] % seconds)
+                self.aggregate_carry[period] = (
+                    periodEpochs[split:],
+                    {k: v[split:] for k, v in periodColumns.items()})
+                periodEpochs = periodEpochs[:split]
+                periodColumns = {k: v[:split] for k, v in
+                                 periodColumns.items()}
+            if len(periodEpochs):
+                self.write_aggregate_group(period, periodEpochs,
+                                           periodColumns)
+
+    def write_aggregate_group(self, period, epochs, columns):
+        '''
+        Append the mean/min/max of every column, the precipitation sum and
+        the vector averaged wind over the intervals of period to the netCDF
+        group named period
+        '''
+        seconds = aggregate.AGGREGATE_PERIODS[period]
+        intervals, starts = aggregate.time_bins(epochs, seconds)
+        if period not in self.ncfile.groups:
+            group = self.ncfile.createGroup(period)
+            group.createDimension('time', None)
+            timevar = group.createVariable('time', 'i4', ('time',),
+                                           zlib=True)
+            timevar.units = self.ncfile.variables['time'].units
+            timevar.calendar = 'gregorian'
+            timevar.standard_name = 'time'
+            timevar.long_name = 'start of the ' + period + ' interval in UTC'
+            samples = group.createVariable('samples', 'i4', ('time',),
+                                           zlib=True)
+            samples.long_name = 'number of samples in the interval'
+        group = self.ncfile.groups[period]
+        start = len(group.dimensions['time'])
+        end = start + len(intervals)
+        group.variables['time'][start:end] = (
+            intervals - TIME_REFERENCE) // 60
+        group.variables['samples'][start:end] = npdiff(
+            npappend(starts, len(epochs)))
+        for name, values in columns.items():
+            if name == WIND_DIRECTION:
+                # directions are averaged as wind vectors
+                continue
+            mean, minimum, maximum = aggregate.aggregate_column(
+                values, starts)[:3]
+            self.write_aggregate_variable(group, name, 'mean', mean,
+                                          start, end)
+            self.write_aggregate_variable(group, name, 'minimum', minimum,
+                                          start, end)
+            self.write_aggregate_variable(group, name, 'maximum', maximum,
+                                          start, end)
+            if name == PRECIPITATION:
+                # mean precipitation rate (mm/h) times interval length
+                self.write_aggregate_variable(
+                    group, name, 'sum', mean * seconds / 3600., start, end,
+                    units='mm', standard_name='precipitation_amount')
+        if WIND_SPEED in columns and WIND_DIRECTION in columns:
+            speed, direction = aggregate.wind_vector_mean(
+                columns[WIND_SPEED], columns[WIND_DIRECTION], starts)
+            self.write_aggregate_variable(group, WIND_SPEED, 'vector_mean',
+                                          speed, start, end)
+            self.write_aggregate_variable(group, WIND_DIRECTION,
+                                          'vector_mean', direction, start,
+                                          end)
+
+    def write_aggregate_variable(self, group, name, method, values, start,
+                                 end, units=None, standard_name=None):
+        '''
+        Write values to the variable <name>_<method> in group, the
+        attributes are copied from variable name in the root group
+        '''
+        variableName = name + '_' + method
+        if variableName not in group.variables:
+            ncvar = group.createVariable(variableName, 'f8', ('time',),
+                                         zlib=True, fill_value=FILL_VALUE)
+            source = self.ncfile.variables[name]
+            for attribute in ['units', 'standard_name', 'long_name']:
+                if attribute in source.ncattrs():
+                    ncvar.setncattr(attribute, source.getncattr(attribute))
+            if units:
+                ncvar.units = units
+            if standard_name:
+                ncvar.standard_name = standard_name
+            ncvar.cell_methods = 'time: ' + method.replace('vector_', '')
+        group.variables[variableName][start:end] = where(
+            isnan(values), FILL_VALUE, values)
+
+    def slab_qc_flags(self, start, end):
+        '''
+        return the quality control flags of the slab [start, end) in
+        self.data as (first index in the output file, flags) per raw field.
+        The step, spike and stuck checks depend on earlier samples, so the
+        tail of the previous slab is checked again with this slab and its
+        new flags are combined with the flags already written. The result
+        does not depend on the chunk size.
+        '''
+        epochs = self.time
+        columns = {}
+        for field_name in quality_control.QC_LIMITS:
+            column = self.data.get(field_name)
+            if column is None or column.dtype == object:
+                # missing in this slab
+                column = full(len(epochs), npnan)
+            columns[field_name] = column
+        carry = self.qc_carry
+        if carry is not None:
+            epochs = npconcatenate((carry['time'], epochs))
+            columns = {k: npconcatenate((carry['data'][k], v)) for k, v in
+                       columns.items()}
+        checked = quality_control.qc_flags(epochs, columns)
+        tailStart = end - len(epochs)
+        flags = {}
+        for field_name, flag in checked.items():
+            if field_name not in self.data or \
+                    self.data[field_name].dtype == object:
+                continue
+            if carry is not None and field_name in carry['flags']:
+                # flags of the tail only gain bits from the later samples
+                flag[:start - tailStart] |= carry['flags'][field_name]
+                flags[field_name] = (tailStart, flag)
+            else:
+                flags[field_name] = (start, flag[start - tailStart:])
+        length = min(len(epochs), quality_control.tail_length(columns))
+        self.qc_carry = {
+            'time': epochs[-length:],
+            'data': {k: v[-length:] for k, v in columns.items()},
+            'flags': {k: flag[-length:] for k, (flagStart, flag) in
+                      flags.items() if flagStart <= end - length}}
+        return flags
+
+    def write_qc_flags(self, variableName, flag, start, end):
+        '''
+        Write the quality control flags of variableName to the netCDF
+        variable <variableName>_qc, which is linked to variableName as
+        CF ancillary variable
+        '''
+        flagName = variableName + '_qc'
+        if flagName not in self.ncfile.variables:
+            flagvar = self.ncfile.createVariable(flagName, 'i1', ('time',),
+                                                 zlib=True)
+            flagvar.long_name = 'quality control flags of ' + variableName
+            try:
+                flagvar.standard_name = (
+                    self.ncfile.variables[variableName].standard_name +
+                    ' status_flag')
+            except AttributeError:
+                pass
+            flagvar.flag_masks = nparray(quality_control.FLAG_MASKS,
+                                         dtype='int8')
+            flagvar.flag_meanings = quality_control.FLAG_MEANINGS
+            self.ncfile.variables[variableName].ancillary_variables = flagName
+        self.ncfile.variables[flagName][start:end] = flag
 
     def write_combined_data_csv(self):
         '''
@@ -290,47 +647,107 @@ class process_raw_data:
         '''
         pass
 
-    def verify_sorting(self):
+    def read_header(self, reader):
         '''
-        Function to verify that the data is sorted according to the time axis
-        defined by self.data['DateUtC'][1:]
+        return the normalised field names of the first non-empty row of a
+        csv reader, None if the file has no header
         '''
-        if not all(earlier <= later for earlier, later in
-                   itertools.izip(self.data[self.dateUTCstring][1:],
-                                  self.data[self.dateUTCstring][2:])):
-            return False
-        else:
-            return True
+        header = next((row for row in reader if row), None)
+        if header is None:
+            return None
+        return fields.header_names(header)
 
-    def sort_data(self):
+    def get_field_names(self):
         '''
-        Function to sort the data according to the time axis defined by
-        self.data['DateUTC'][1:]
+        get the field names of the first txt file in inputdir with data,
+        empty if none of the files has a header
         '''
-        idx_sort = argsort(self.data[self.dateUTCstring][1:])
-        for field_name in self.data.keys():
-            if field_name is not self.dateUTCstring:
-                self.data[field_name][1:] = nparray(
-                    self.data[field_name][1:])[idx_sort].tolist()
-
-    def get_field_names(self):
+        self.field_names = []
         # get a list of all txt files in inputdir, sorted by filename
         filelist = sorted(glob.glob(os.path.join(self.inputdir, '*.txt')))
         for inputfile in filelist:
             with open(inputfile, 'r') as csvin:
-                reader = csv.DictReader(csvin, delimiter=',')
-                # loader header information
-                try:
-                    self.field_names = {k: [v] for k, v in
-                                        reader.next().items()}
-                    self.field_names = self.field_names.keys()
-                #self.field_names = self.field_names[None][0][:]
-                except StopIteration:
-                    pass
-                try:
-                    reader.next()
+                reader = csv.reader(csvin, delimiter=',')
+                header = self.read_header(reader)
+                if header is None:
+                    continue
+                self.field_names = header
+                if next((row for row in reader if row), None) is not None:
                     # first txt file with data in it found
                     # use field_names from this file
                     break
-                except StopIteration:
-                    pass
+
+class append_raw_data(process_raw_data):
+    '''
+    Append the samples of daily csv files that are newer than the end of
+    the netCDF output file of a station, used by the near-real-time ingest.
+    Quality control flags and aggregates need the full time series and are
+    not written in append mode.
+    '''
+    def __init__(self, inputdir, outputdir, lat=False, lon=False,
+                 metadata=None):
+        self.inputdir = inputdir
+        self.outputdir = outputdir
+        filename = os.path.basename(self.inputdir) + '.nc'
+        self.outputfile = os.path.join(self.outputdir, filename)
+        self.lat = lat
+        self.lon = lon
+        # the location is only looked up when the output file is created
+        self.metadata = metadata
+        self.chunk = None
+        self.qc = False
+        self.aggregate_periods = []
+        self.aggregate_carry = {}
+        self.qc_carry = None
+        self.dateUTCstring = None
+
+    def end_time(self):
+        '''
+        return the end (epoch seconds) of the last minute in the netCDF
+        output file, None if the file does not exist or is empty
+        '''
+        if not os.path.exists(self.outputfile):
+            return None
+        ncfile = ncdf(self.outputfile, 'r')
+        try:
+            timevar = ncfile.variables['time']
+            if len(timevar) == 0:
+                return None
+            return TIME_REFERENCE + 60 * (int(timevar[-1]) + 1)
+        finally:
+            ncfile.close()
+
+    def append(self, filelist, after=None):
+        '''
+        append the samples in filelist from after (epoch seconds) on. The
+        default is the end of the output file: the time axis is stored in
+        minutes, so after a restart samples in the last stored minute are
+        not appended again. Returns the appended time axis (epoch seconds).
+        '''
+        if self.dateUTCstring is None:
+            self.get_field_names()
+            try:
+                self.dateUTCstring = [s for s in self.field_names if
+                                      "DateUTC" in s][0]
+            except IndexError:
+                # no file with data yet
+                return zeros(0, dtype='int64')
+        if after is None:
+            after = self.end_time()
+        # only the rows from after on are typed and sorted
+        self.combine_raw_data(filelist, after)
+        if len(self.time) == 0:
+            return self.time
+        if os.path.exists(self.outputfile):
+            self.ncfile = ncdf(self.outputfile, 'a')
+        else:
+            if not (self.lat and self.lon) and self.metadata is not None:
+                # location from the station metadata cache
+                self.lat, self.lon = self.metadata.location(
+                    os.path.basename(self.inputdir))
+            self.create_netcdf_file()
+        try:
+            self.write_netcdf_slab()
+        finally:
+            self.ncfile.close()
+        return self.time
@@ -0,0 +1,144 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Registry of the Wunderground csv fields, maps every raw
+                field to its netCDF variable:
+                    * field(name, units, standard_name, long_name, ...)
+                    * FIELDS / DERIVED_FIELDS
+                    * header_names(header)
+                    * compile_fields(field_names)
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:
+Last Modified:
+License:        Apache 2.0
+Notes:          * Fields in imperial units (F, inch, mph) are converted to
+                  the variable of the metric field, so stations with either
+                  unit system give the same netCDF variables
+                * Conversions are vectorized, they get a float array with
+                  nan for missing values
+                * A field that is not in FIELDS is written under its raw
+                  name, numeric if the column is numeric
+'''
+
+# missing values in the netCDF file
+FILL_VALUE = -999
+# columns that are not written to the netCDF file, the UTC time is the
+# time axis
+SKIPPED_FIELDS = ['Time', '<br>', '', None]
+
+def field(name, units=None, standard_name=None, long_name=None,
+          convert=None, dtype='f8', fill_value=FILL_VALUE, source=None):
+    '''
+    return the definition of a field: the netCDF variable name, dtype
+    ('f8' or str), fill value, CF attributes and the conversion of the raw
+    values to the units of the variable (None if no conversion is needed).
+    A derived field is converted from the numeric variable source instead
+    of a raw field.
+    '''
+    attributes = {}
+    for attribute, value in [('units', units),
+                             ('standard_name', standard_name),
+                             ('long_name', long_name)]:
+        if value is not None:
+            attributes[attribute] = value
+    return {'name': name, 'dtype': dtype, 'attributes': attributes,
+            'convert': convert, 'fill_value': fill_value, 'source': source}
+
+def scale(factor, offset=0.):
+    '''
+    return a vectorized linear unit conversion
+    '''
+    def convert(values):
+        return values * factor + offset
+    return convert
+
+def fahrenheit_to_celsius(values):
+    return (values - 32.) / 1.8
+
+def fahrenheit_to_kelvin(values):
+    return (values - 32.) / 1.8 + 273.15
+
+# raw csv fields
+FIELDS = {
+    'TemperatureC': field('temperature', 'K', 'air_temperature',
+                          'air temperature', convert=scale(1., 273.15)),
+    'TemperatureF': field('temperature', 'K', 'air_temperature',
+                          'air temperature', convert=fahrenheit_to_kelvin),
+    'DewpointC': field('DewpointC', 'C', 'dew_point_temperature',
+                       'dewpoint temperature'),
+    'DewpointF': field('DewpointC', 'C', 'dew_point_temperature',
+                       'dewpoint temperature',
+                       convert=fahrenheit_to_celsius),
+    'PressurehPa': field('PressurehPa', 'hPa', 'surface_air_pressure',
+                         'surface pressure'),
+    'PressureIn': field('PressurehPa', 'hPa', 'surface_air_pressure',
+                        'surface pressure', convert=scale(33.8639)),
+    'WindDirection': field('WindDirection', dtype=str),
+    'WindDirectionDegrees': field('WindDirectionDegrees', 'degrees'),
+    'WindSpeedKMH': field('WindSpeedKMH', 'km/h', 'wind_speed',
+                          'wind speed'),
+    'WindSpeedMPH': field('WindSpeedKMH', 'km/h', 'wind_speed',
+                          'wind speed', convert=scale(1.609344)),
+    'WindSpeedGustKMH': field('WindSpeedGustKMH', 'km/h',
+                              'wind_speed_of_gust', 'gust wind speed'),
+    'WindSpeedGustMPH': field('WindSpeedGustKMH', 'km/h',
+                              'wind_speed_of_gust', 'gust wind speed',
+                              convert=scale(1.609344)),
+    'Humidity': field('Humidity', '%', 'relative_humidity',
+                      'relative humidity'),
+    'HourlyPrecipMM': field('HourlyPrecipMM', 'mm/h', long_name='hourly ' +
+                            'precipitation'),
+    'HourlyPrecipIn': field('HourlyPrecipMM', 'mm/h', long_name='hourly ' +
+                            'precipitation', convert=scale(25.4)),
+    'dailyrainMM': field('dailyrainMM', 'mm/day', long_name='daily ' +
+                         'precipitation'),
+    'dailyrainin': field('dailyrainMM', 'mm/day', long_name='daily ' +
+                         'precipitation', convert=scale(25.4)),
+    'SolarRadiationWatts/m^2': field(
+        'SolarRadiation', 'W m-2',
+        'surface_downwelling_shortwave_flux_in_air', 'solar radiation'),
+    'Conditions': field('Conditions', dtype=str),
+    'Clouds': field('Clouds', dtype=str),
+    'SoftwareType': field('SoftwareType', dtype=str),
+    }
+
+# variables derived during the conversion, the wind components are
+# computed from the wind speed and direction
+DERIVED_FIELDS = {
+    'wind_speed': field('wind_speed', 'm s-1', 'wind_speed', 'wind speed',
+                        convert=scale(1 / 3.6), source='WindSpeedKMH'),
+    'wind_speed_of_gust': field('wind_speed_of_gust', 'm s-1',
+                                'wind_speed_of_gust', 'gust wind speed',
+                                convert=scale(1 / 3.6),
+                                source='WindSpeedGustKMH'),
+    'eastward_wind': field('eastward_wind', 'm s-1', 'eastward_wind',
+                           'eastward wind component'),
+    'northward_wind': field('northward_wind', 'm s-1', 'northward_wind',
+                            'northward wind component'),
+    }
+
+def header_names(header):
+    '''
+    return the normalised field names of a csv header row, the <br> tag
+    that ends the header line is removed from the last field name
+    '''
+    names = [name.strip() for name in header]
+    return [name[:-len('<br>')].strip() if name.endswith('<br>') and
+            name != '<br>' else name for name in names]
+
+# compiled field lists per header
+_compiled = {}
+
+def compile_fields(field_names):
+    '''
+    return the (raw field name, definition) of every field of a header that
+    is written to the netCDF file. Unknown fields get a definition with
+    dtype None, their type follows the column. The result is cached per
+    header.
+    '''
+    key = tuple(sorted(f for f in field_names if f is not None))
+    if key not in _compiled:
+        _compiled[key] = [(field_name, FIELDS.get(field_name) or
+                           field(field_name, dtype=None)) for field_name in
+                          key if field_name not in SKIPPED_FIELDS]
+    return _compiled[key]
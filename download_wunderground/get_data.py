@@ -17,18 +17,39 @@ import cStringIO
 import formatter
 import os
 import sys
-from lxml import html
 import numbers
 import json
-import csv
+import hashlib
+import shutil
+import tempfile
 from multiprocessing import Pool, Manager, cpu_count
-import time
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
 from datetime import datetime
 import download_wunderground.utils as utils
+from download_wunderground.archive import archive_raw_data
+from download_wunderground.station_metadata import station_metadata
+from download_wunderground.station_metadata import METADATA_FILE
 import logging
-from download_wunderground.create_netcdf import *
-import shutil
-import tarfile
+
+HISTORY_URL = 'http://www.wunderground.com/weatherstation/WXDailyHistory.asp'
+# download workers:
+#   thread: threads sharing one http session with keep-alive connections,
+#           scales to many simultaneous downloads
+#   process: separate processes that parse the pages in parallel, faster
+#            for a few simultaneous downloads
+DOWNLOAD_BACKENDS = ['thread', 'process']
+# number of simultaneous downloads from which the thread backend is faster
+# (see benchmarks/downloads.py), used if no backend is given
+THREAD_BACKEND_WORKERS = 16
+
+def default_backend(workers):
+    '''
+    return the download backend for workers simultaneous downloads
+    '''
+    return 'thread' if workers >= THREAD_BACKEND_WORKERS else 'process'
+
+logger = logging.getLogger()
 
 class get_wundergrond_data:
     def __init__(self, opts):
@@ -38,40 +59,81 @@ class get_wundergrond_data:
         self.keep = opts.keep
         self.startdate = self.validate_date(opts.startdate)
         self.enddate = self.validate_date(opts.enddate)
-        self.processes = 8  # number of simultaneous processes/downloads
-        logger = logging.getLogger()
-        global logger
+        # number of simultaneous downloads and how they are run
+        self.processes = opts.processes
+        self.backend = opts.backend
+        # only poll open days, existing raw files are kept between runs
+        self.refresh = opts.refresh
+        # netCDF4/numpy are only needed for the conversion, import them
+        # here instead of for every use of this module
+        from download_wunderground.create_netcdf import process_raw_data
+        from download_wunderground.create_netcdf import append_raw_data
         if not any([opts.stationid, self.csvfile]):
             raise IOError('stationid or csv file with stationids should ' +
                           'be specified')
+        # station locations are cached between runs
+        metadata = station_metadata(opts.metadata or os.path.join(
+            opts.outputdir, METADATA_FILE))
         if self.csvfile:
-            self.load_csvfile()
-            longitudes = self.csvdata['lon']
-            latitudes = self.csvdata['lat']
-            if not opts.stationid:
-                stationids = self.csvdata['Station ID']
-            else:
-                stationids = [opts.stationid]
-        else:
+            stationids = metadata.import_csvfile(self.csvfile)
+        if opts.stationid:
             stationids = [opts.stationid]
-        for idx, self.stationid in enumerate(stationids):
+        # archive the raw files in the background during the next download,
+        # refresh needs the raw files of the previous run so they are
+        # archived but not removed
+        method = opts.archive
+        if method is None:
+            # the raw files of a refresh are kept in TMP_DIR already
+            method = 'none' if self.refresh else 'tar.gz'
+        archiver = archive_raw_data(opts.outputdir, method=method,
+                                    remove=not self.refresh)
+        for self.stationid in stationids:
             self.outputdir = os.path.join(opts.TMP_DIR, self.stationid)
             if not os.path.exists(self.outputdir):
                 os.makedirs(self.outputdir)
-            self.get_data_multiprocessing()
-            try:
-              lat = latitudes[idx]
-              lon = longitudes[idx]
-              process_raw_data(self.outputdir, opts.outputdir, lat, lon)
-            except NameError:
-              process_raw_data(self.outputdir, opts.outputdir)
-            # create tar file of directory with csv files
-            outputtar = os.path.join(opts.outputdir, self.stationid + '.tar.gz')
-            tar = tarfile.open(outputtar, "w:gz")
-            tar.add(self.outputdir)
-            tar.close()
-            # remove csv files
-            shutil.rmtree(self.outputdir)
+            changed = self.get_data_multiprocessing()
+            ncfile = os.path.join(opts.outputdir, self.stationid + '.nc')
+            if self.refresh and os.path.exists(ncfile):
+                if not changed:
+                    logger.info('No new data for stationid: ' +
+                                self.stationid)
+                    continue
+                if opts.qc or opts.aggregate:
+                    # quality control flags and aggregates need the full
+                    # time series, the netCDF file is recreated
+                    self.recreate_netcdf(process_raw_data, opts, metadata)
+                else:
+                    # only append the samples of the changed days
+                    append_raw_data(self.outputdir, opts.outputdir,
+                                    metadata=metadata).append(
+                        [os.path.join(self.outputdir, outputfile) for
+                         outputfile in sorted(changed)])
+            else:
+                process_raw_data(self.outputdir, opts.outputdir,
+                                 chunk=opts.chunk, qc=opts.qc,
+                                 aggregate_periods=opts.aggregate,
+                                 metadata=metadata)
+            # archive and remove directory with csv files
+            archiver.submit(self.outputdir, self.stationid)
+        archiver.join()
+
+    def recreate_netcdf(self, process_raw_data, opts, metadata):
+        '''
+        recreate the netCDF file of the current station from all its raw
+        files, the file is written in a temporary directory and replaces
+        the existing file only if the conversion succeeded
+        '''
+        tmpdir = tempfile.mkdtemp(dir=opts.outputdir)
+        try:
+            process_raw_data(self.outputdir, tmpdir, chunk=opts.chunk,
+                             qc=opts.qc, aggregate_periods=opts.aggregate,
+                             metadata=metadata)
+            tmpfile = os.path.join(tmpdir, self.stationid + '.nc')
+            if os.path.exists(tmpfile):
+                os.rename(tmpfile, os.path.join(opts.outputdir,
+                                                self.stationid + '.nc'))
+        finally:
+            shutil.rmtree(tmpdir)
 
     def validate_date(self, datestring):
       '''
@@ -138,88 +200,6 @@ class get_wundergrond_data:
             logger.info('Download data for stationid: ' + self.stationid +
                         ' [completed]')
 
-    def get_station_location(self, stationid):
-        '''
-        get the location of a Wunderground stationid
-        '''
-        logger.info('Get station location of stationid: ' + stationid)
-        # set url to get the location from
-        url = 'http://dutch.wunderground.com/personal-weather-station/dashboard?ID=' + stationid
-        # open and read url
-        handler = urllib2.urlopen(url)
-        content = handler.read()
-        # find the correct html tag that has the location info in it
-        tree = html.fromstring(content).find_class('subheading')
-        # get the string of the location
-        if len(tree) == 1:
-            raw_location = str(tree[0].text_content())
-        else:
-            logger.error('Cannot parse location from html file')
-            raise IOError('Cannot parse location from html file')
-        # remove anything non-numeric from the string and create a list
-        location_list = [float(s) for s in raw_location.split() if
-                         utils.is_number(s)]
-        location_items = ['lat', 'lon', 'height']
-        # create a dictionary for the location
-        location = dict(zip(location_items, location_list))
-        # check if latitude and longitude are not zero
-        if int(location['lat']) == 0 or int(location['lon']) == 0:
-            logger.error('Could not extract a valid location for ' +
-                         'stationid: ' + stationid)
-            raise ValueError('Could not extract a valid location for ' +
-                             'stationid: ' + stationid)
-        return location
-
-    def get_station_zipcode(self, location):
-        '''
-        get zipcode for a given location
-        location['lat'] gives latitude of the location
-        location['lon'] gives the longitude of the location
-        '''
-        logger.info('Get zipcode of stationid: ' + self.stationid)
-        # google maps api url
-        url = 'https://maps.googleapis.com/maps/api/geocode/json?latlng=' + \
-            str(location['lat']) + ',' + str(location['lon'])
-        # open url
-        handler = urllib2.urlopen(url)
-        # load json
-        js = json.load(handler)
-        # extract the address_component
-        address_components = js['results'][0]['address_components']
-        # extract the zipcode from the address component
-        zipcode = [address_components[x]['long_name'] for x in
-                   range(0, len(address_components)) if
-                   address_components[x]['types'][0] == 'postal_code'][0]
-        # return the zipcode
-        return zipcode.encode('utf-8')
-
-    def load_csvfile(self):
-        '''
-        load data csvfile
-        '''
-        logger.info('Load stationdata from csv file')
-        with open(self.csvfile, 'r') as csvin:
-            reader = csv.DictReader(csvin, delimiter=',')
-            try:
-                self.csvdata
-            except AttributeError:
-                reader.next()
-                try:
-                    self.csvdata = {k.strip(): [utils.fitem(v)] for k, v in
-                                    reader.next().items()}
-                except StopIteration:
-                    pass
-            current_row = 0
-            for line in reader:
-                current_row += 1
-                if current_row == 1:  # header
-                    # skip the header
-                    continue
-                for k, v in line.items():
-                    if k is not None:  # skip over empty fields
-                        k = k.strip()
-                        self.csvdata[k].append(utils.fitem(v))
-
     def get_data_multiprocessing(self):
         '''
         Download data from Weather Underground website for a given stationid
@@ -227,55 +207,148 @@ class get_wundergrond_data:
             as csv to a separate txt file for each day.
             [multiprocessing code]
         '''
-        logger.info('Download data for stationid: ' + self.stationid +
-                    ' [start]')
-        pool = Pool(self.processes)  # number of processes
+        return download_station(self.stationid, self.startdate,
+                                self.enddate, self.outputdir, self.keep,
+                                backend=self.backend,
+                                workers=self.processes,
+                                refresh=self.refresh)
+
+def download_station(stationid, startdate, enddate, outputdir, keep=False,
+                     backend=None, workers=8, history_url=HISTORY_URL,
+                     progress=True, refresh=False):
+    '''
+    Download the daily files of stationid from startdate to enddate to
+        outputdir with workers simultaneous downloads. backend selects a
+        pool of threads sharing one keep-alive http session ('thread') or
+        a pool of processes ('process'), see DOWNLOAD_BACKENDS. The default
+        depends on the number of workers (see default_backend).
+        With refresh, existing files of closed days are kept and open days
+        are only rewritten if their content changed (see open_day).
+        Returns the names of the files that were (re)written.
+    '''
+    logger.info('Download data for stationid: ' + stationid + ' [start]')
+    if backend is None:
+        backend = default_backend(workers)
+    if backend not in DOWNLOAD_BACKENDS:
+        raise ValueError('Unknown download backend: ' + str(backend))
+    if backend == 'thread':
+        pool = ThreadPool(workers)
+        q = Queue()
+        session = utils.http_session()
+    else:
+        pool = Pool(workers)  # number of processes
         m = Manager()
         q = m.Queue()
-        args = [(self.stationid, self.startdate, td, self.outputdir,
-                 self.keep, q) for td in range(0, (
-                     self.enddate - self.startdate).days + 1)]
-        ndays = range(0, (self.enddate - self.startdate).days + 1)
-        result = pool.map_async(get_daily_wunderground, args)
-        # monitor loop
-        while True:
-            if result.ready():
+        # every process opens its own connections
+        session = None
+    ndays = range(0, (enddate - startdate).days + 1)
+    args = [(stationid, startdate, td, outputdir, keep, q, session,
+             history_url, refresh) for td in ndays]
+    result = pool.map_async(get_daily_wunderground, args)
+    # monitor loop
+    while True:
+        if result.ready():
+            if progress:
                 utils.progressbar2(len(ndays), len(ndays),
                                    prefix="Downloading " +
-                                   self.stationid + ": ", size=60)
+                                   stationid + ": ", size=60)
                 sys.stdout.write("\n")
                 sys.stdout.flush()
-                break
-            else:
+            break
+        else:
+            if progress:
                 length = q.qsize()
                 utils.progressbar2(length, len(ndays),
                                    prefix="Downloading " +
-                                   self.stationid + ": ", size=60)
-                time.sleep(1)
-        # clean up
-        pool.close()
-        pool.join()
+                                   stationid + ": ", size=60)
+            result.wait(1)
+    # clean up
+    pool.close()
+    pool.join()
+    return [outputfile for outputfile in result.get() if outputfile]
+
+def open_day(current_date):
+    '''
+    return True if the (station local) day current_date may still receive
+    observations. Local days end at most a day after the UTC day, so the
+    current and the previous UTC day are open.
+    '''
+    return current_date.date() >= (datetime.utcnow() -
+                                   timedelta(days=1)).date()
+
+def state_filename(outputdir, outputfile):
+    '''
+    return the file with the download state (validators and payload hash)
+    of outputfile, the leading dot hides it from the *.txt input files
+    '''
+    return os.path.join(outputdir, '.' + outputfile + '.json')
+
+def write_state(outputdir, outputfile, state):
+    '''
+    write the download state of outputfile, the file is replaced
+    atomically so a failed write never leaves a partial state
+    '''
+    filename = state_filename(outputdir, outputfile)
+    with open(filename + '.tmp', 'w') as fp:
+        json.dump(state, fp)
+    os.rename(filename + '.tmp', filename)
+
+def fetch_daily(url, session, state):
+    '''
+    download url, conditional on the ETag/Last-Modified in state. Returns
+    the payload (None if it was not modified) and the new validators.
+    '''
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    if session is not None:
+        status, response_headers, content = session.request(url, headers)
+    else:
+        try:
+            handler = urllib2.urlopen(urllib2.Request(url, headers=headers))
+        except urllib2.HTTPError as e:
+            if e.code != 304:
+                raise
+            status, response_headers, content = 304, {}, None
+        else:
+            status = 200
+            response_headers = {k.lower(): v for k, v in
+                                handler.info().items()}
+            content = handler.read()
+            handler.close()
+    if status == 304:
+        return None, {}
+    return content, {'etag': response_headers.get('etag'),
+                     'last_modified': response_headers.get('last-modified')}
 
 def get_daily_wunderground(args):
     '''
     Download Wunderground for a supplied station and date.
     Input argument args consists of (stationid, startdate, td, outputdir,
-        keep, q), where
+        keep, q, session, history_url, refresh), where
         stationid: stationid on Wunderground website
         startdate: date from which current date is calculated from using td
         td: timedelta in days from startdate
         outputdir: output directory where files are saved
         keep: True if already downloaded files of not size NULL are kept
         q: iterator queue for multiprocessing
+        session: shared utils.http_session, None to use urllib2
+        history_url: url of the daily history page
+        refresh: True to poll existing files of open days with conditional
+            requests and only rewrite them if the payload changed
+    Returns the name of the outputfile if it was (re)written.
     '''
     # input arguments of the function
-    stationid, startdate, td, outputdir, keep, q = args
+    stationid, startdate, td, outputdir, keep, q, session, history_url, \
+        refresh = args
     # increase multiprocessing iterator queue for progressbar2
     q.put(td)
     # increase the date by 1 day for the next download
     current_date = startdate + timedelta(days=td)
     # set download url
-    url = 'http://www.wunderground.com/weatherstation/WXDailyHistory.asp?ID=' + \
+    url = history_url + '?ID=' + \
         stationid + '&day=' + str(current_date.day) + '&year=' + \
         str(current_date.year) + '&month=' + \
         str(current_date.month) + '&format=1'
@@ -284,38 +357,65 @@ def get_daily_wunderground(args):
         + str(current_date.month).zfill(2) + \
         str(current_date.day).zfill(2) + '.txt'
     # check if we want to keep previous downloaded files
-    if keep:
-        if os.path.exists(os.path.join(outputdir, outputfile)):
+    exists = os.path.exists(os.path.join(outputdir, outputfile))
+    if keep or refresh:
+        if exists:
             # check if filesize is not null
             if os.path.getsize(os.path.join(outputdir,
                                             outputfile)) > 0:
-                # file exists and is not null, continue next iteration
-                return
+                if not (refresh and open_day(current_date)):
+                    # file exists and is not null, continue next iteration
+                    return
             else:
                 # file exists but is null, so remove and redownload
                 os.remove(os.path.join(outputdir, outputfile))
+                exists = False
         elif os.path.exists(os.path.join(outputdir, outputfile)):
             os.remove(os.path.join(outputdir, outputfile))
-    # open outputfile
-    with open(os.path.join(outputdir, outputfile), 'wb') as outfile:
-        # open and read the url
-        handler = urllib2.urlopen(url)
-        content = handler.read()
-        # convert spaces to non-breaking spaces
-        content = content.replace(' ', '&nbsp;')
-        # Removing all the HTML tags from the file
-        outstream = cStringIO.StringIO()
-        parser = htmllib.HTMLParser(
-            formatter.AbstractFormatter(
-                formatter.DumbWriter(outstream)))
-        parser.feed(content)
-        # convert spaces back to regular whitespace (' ')
-        content = outstream.getvalue().replace('\xa0', ' ')
+    state = {}
+    if refresh and exists:
+        try:
+            with open(state_filename(outputdir, outputfile), 'r') as fp:
+                state = json.load(fp)
+        except (IOError, ValueError):
+            state = {}
+    # open and read the url
+    try:
+        content, validators = fetch_daily(url, session, state)
+    except IOError as e:
+        logger.error('Download of ' + url + ' failed: ' + str(e))
+        return
+    if content is None:
+        # not modified since the last download
+        return
+    digest = hashlib.sha1(content).hexdigest()
+    validators['sha1'] = digest
+    if refresh and exists and state.get('sha1') == digest:
+        # same payload, no need to parse and rewrite the file
+        write_state(outputdir, outputfile, validators)
+        return
+    # convert spaces to non-breaking spaces
+    content = content.replace(' ', '&nbsp;')
+    # Removing all the HTML tags from the file
+    outstream = cStringIO.StringIO()
+    parser = htmllib.HTMLParser(
+        formatter.AbstractFormatter(
+            formatter.DumbWriter(outstream)))
+    parser.feed(content)
+    # convert spaces back to regular whitespace (' ')
+    content = outstream.getvalue().replace('\xa0', ' ')
+    # close outstream
+    outstream.close()
+    # write to a hidden temporary file, the outputfile is only replaced
+    # once it is complete
+    tmpfile = os.path.join(outputdir, '.' + outputfile + '.tmp')
+    with open(tmpfile, 'wb') as outfile:
         # write output
         outfile.write(content)
-        # close handler and outstream
-        outstream.close()
-        handler.close()
+    os.rename(tmpfile, os.path.join(outputdir, outputfile))
+    if refresh:
+        # the state is only saved for a raw file that was written
+        write_state(outputdir, outputfile, validators)
     logger.info('Download data for stationid: ' + stationid +
                 ' [completed]')
-    return
+    return outputfile
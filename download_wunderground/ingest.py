@@ -0,0 +1,268 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Near-real-time ingest of Wunderground stations:
+                    * ingest_daemon(stationids, outputdir, workdir, ...)
+                    * ingest_daemon.run(duration=None)
+                Stations are polled on a staggered schedule, the open days
+                are downloaded with conditional requests and only samples
+                newer than the end of the netCDF file of a station are
+                appended to it.
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:
+Last Modified:
+License:        Apache 2.0
+Notes:          * The lag (age of the newest sample) of every station and
+                  the throughput are written to a json status file
+                * Quality control flags and aggregates are not written by
+                  the ingest, convert the raw files for those
+                * Raw files of days that are no longer polled are appended
+                  to the log archive of the station and removed
+'''
+
+import glob
+import heapq
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+import download_wunderground.utils as utils
+from download_wunderground.get_data import get_daily_wunderground
+from download_wunderground.get_data import HISTORY_URL
+from download_wunderground.get_data import state_filename
+from download_wunderground.archive import write_raw_log
+from download_wunderground.archive import ARCHIVE_EXTENSIONS
+from download_wunderground.create_netcdf import append_raw_data
+
+STATUS_FILE = 'wunderground_ingest.json'
+# seconds between two polls of a station
+DEFAULT_INTERVAL = 300
+# what happens to the raw files of closed days: appended to the log
+# archive and removed, or only removed
+INGEST_ARCHIVE_METHODS = ['log', 'none']
+
+logger = logging.getLogger()
+
+def poll_dates():
+    '''
+    return the dates of the (station local) days that can receive new
+    samples, local days differ at most a day from the UTC day
+    '''
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0,
+                                      microsecond=0)
+    return [today + timedelta(days=td) for td in [-1, 0, 1]]
+
+class ingest_daemon:
+    '''
+    Poll stationids every interval seconds with workers simultaneous
+    downloads and append new samples to <outputdir>/<stationid>.nc. The raw
+    daily files are kept in <workdir>/<stationid> for the conditional
+    requests of the next poll. Once a day is no longer polled its raw file
+    is appended to <outputdir>/<stationid>.log.gz (archive 'log') and
+    removed.
+    '''
+    def __init__(self, stationids, outputdir, workdir,
+                 interval=DEFAULT_INTERVAL, workers=8, metadata=None,
+                 history_url=HISTORY_URL, status_file=None, archive='log'):
+        if archive not in INGEST_ARCHIVE_METHODS:
+            raise ValueError('Unknown archive method: ' + str(archive))
+        self.stationids = list(stationids)
+        self.outputdir = outputdir
+        self.workdir = workdir
+        self.interval = interval
+        self.workers = workers
+        self.metadata = metadata
+        self.history_url = history_url
+        self.archive = archive
+        self.status_file = status_file or os.path.join(outputdir,
+                                                       STATUS_FILE)
+        self.session = utils.http_session()
+        # appenders per station, they remember the end of the netCDF file
+        self.appenders = {}
+        self.after = {}
+        # netCDF/HDF5 is not thread safe, appends are serialized
+        self.write_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.running = False
+        # lag and throughput
+        self.started = time.time()
+        self.polls = 0
+        self.errors = 0
+        self.samples = 0
+        self.latest = {}
+        # first poll of every station spread over one interval
+        self.schedule = [(self.started + self.interval * idx /
+                          max(len(self.stationids), 1), stationid) for
+                         idx, stationid in enumerate(self.stationids)]
+        heapq.heapify(self.schedule)
+
+    def run(self, duration=None):
+        '''
+        poll the stations until stopped by SIGTERM/SIGINT or until duration
+        seconds have passed
+        '''
+        self.running = True
+        if threading.current_thread().name == 'MainThread':
+            signal.signal(signal.SIGTERM, self.stop)
+        pool = ThreadPool(self.workers)
+        inflight = [0]
+        last_status = 0
+        try:
+            while self.running:
+                now = time.time()
+                if duration is not None and now - self.started >= duration:
+                    break
+                with self.lock:
+                    while (self.schedule and self.schedule[0][0] <= now and
+                           inflight[0] < self.workers):
+                        due, stationid = heapq.heappop(self.schedule)
+                        inflight[0] += 1
+                        pool.apply_async(
+                            self.poll, (stationid, due),
+                            callback=lambda result: self.reschedule(
+                                result, inflight))
+                    wait = self.schedule[0][0] - now if self.schedule \
+                        else 1.
+                if now - last_status >= 10:
+                    self.write_status()
+                    last_status = now
+                time.sleep(min(max(wait, 0.01), 1.))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.running = False
+            pool.close()
+            pool.join()
+            self.write_status()
+
+    def stop(self, *args):
+        '''
+        stop the daemon after the running polls
+        '''
+        self.running = False
+
+    def reschedule(self, result, inflight):
+        '''
+        schedule the next poll of a station one interval after the previous
+        one, or immediately if the station fell behind
+        '''
+        stationid, due = result
+        with self.lock:
+            inflight[0] -= 1
+            heapq.heappush(self.schedule, (max(due + self.interval,
+                                               time.time()), stationid))
+
+    def poll(self, stationid, due):
+        '''
+        download the open days of stationid and append the new samples to
+        its netCDF file, returns (stationid, due) for the scheduler
+        '''
+        try:
+            inputdir = os.path.join(self.workdir, stationid)
+            if not os.path.exists(inputdir):
+                os.makedirs(inputdir)
+            # the first poll also checks files of a previous run that may
+            # not have been appended yet
+            first = stationid not in self.appenders
+            changed = []
+            polled = []
+            for current_date in poll_dates():
+                # reuse the refresh mode of the download
+                outputfile = get_daily_wunderground(
+                    (stationid, current_date, 0, inputdir, True, Queue(),
+                     self.session, self.history_url, True))
+                polled.append(stationid + '_' + current_date.strftime(
+                    '%Y%m%d') + '.txt')
+                if first and not outputfile:
+                    outputfile = polled[-1]
+                if outputfile and os.path.exists(os.path.join(
+                        inputdir, outputfile)):
+                    changed.append(os.path.join(inputdir, outputfile))
+            # raw files of days that are no longer polled
+            closed = sorted(f for f in glob.glob(os.path.join(
+                inputdir, '*.txt')) if os.path.basename(f) not in polled)
+            if first:
+                changed = closed + changed
+            appended = 0
+            if changed:
+                with self.write_lock:
+                    if stationid not in self.appenders:
+                        self.appenders[stationid] = append_raw_data(
+                            inputdir, self.outputdir,
+                            metadata=self.metadata)
+                    epochs = self.appenders[stationid].append(
+                        changed, self.after.get(stationid))
+                appended = len(epochs)
+                if appended:
+                    # the exact time of the newest sample is known while
+                    # the daemon runs, later samples in the same minute
+                    # are appended by the next poll
+                    self.after[stationid] = int(epochs[-1]) + 1
+            if closed:
+                self.remove_closed(stationid, inputdir, closed)
+            with self.lock:
+                self.polls += 1
+                self.samples += appended
+                if appended:
+                    self.latest[stationid] = int(epochs[-1])
+            logger.info('Poll ' + stationid + ': ' + str(appended) +
+                        ' new samples')
+        except Exception as e:
+            # a failing station must not stop the daemon
+            logger.error('Poll of ' + stationid + ' failed: ' + str(e))
+            with self.lock:
+                self.errors += 1
+        return stationid, due
+
+    def remove_closed(self, stationid, inputdir, closed):
+        '''
+        archive and remove the raw files (and download states) of closed
+        days, their samples have been appended by this or an earlier poll
+        '''
+        if self.archive == 'log':
+            logfile = os.path.join(self.outputdir,
+                                   stationid + ARCHIVE_EXTENSIONS['log'])
+            write_raw_log(inputdir, logfile, filelist=closed)
+        for inputfile in closed:
+            statefile = state_filename(inputdir, os.path.basename(inputfile))
+            if os.path.exists(statefile):
+                os.remove(statefile)
+            os.remove(inputfile)
+        logger.info('Archived ' + str(len(closed)) + ' closed days of ' +
+                    stationid)
+
+    def status(self):
+        '''
+        return the lag (seconds since the newest sample) per station and
+        the polls, errors and appended samples (total and per second)
+        '''
+        now = time.time()
+        with self.lock:
+            elapsed = max(now - self.started, 1e-6)
+            lag = {stationid: int(now - latest) for stationid, latest in
+                   self.latest.items()}
+            return {'time': datetime.utcfromtimestamp(now).strftime(
+                        '%Y-%m-%d %H:%M:%S'),
+                    'stations': len(self.stationids),
+                    'polls': self.polls, 'errors': self.errors,
+                    'samples': self.samples,
+                    'samples_per_second': self.samples / elapsed,
+                    'polls_per_second': self.polls / elapsed,
+                    'max_lag': max(lag.values()) if lag else None,
+                    'lag': lag}
+
+    def write_status(self):
+        '''
+        write the status to the status file, replaced atomically so readers
+        never see a partial file
+        '''
+        status = self.status()
+        tmpfile = self.status_file + '.tmp'
+        with open(tmpfile, 'w') as fp:
+            json.dump(status, fp, indent=1, sort_keys=True)
+        os.rename(tmpfile, self.status_file)
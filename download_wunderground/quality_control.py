@@ -0,0 +1,191 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Vectorized quality control of Wunderground station data:
+                    * range_check(values, limits)
+                    * step_check(epochs, values, max_step)
+                    * spike_check(values, max_spike)
+                    * stuck_check(epochs, values, max_duration)
+                    * qc_flags(epochs, data)
+                    * tail_length(data)
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:
+Last Modified:
+License:        Apache 2.0
+Notes:          * Checks operate on the typed columns of process_raw_data
+                  in the raw (station) units
+                * Results are bit flags, written as CF ancillary_variables
+'''
+
+from numpy import abs as npabs
+from numpy import append as npappend
+from numpy import concatenate as npconcatenate
+from numpy import cumsum
+from numpy import diff as npdiff
+from numpy import errstate
+from numpy import isnan
+from numpy import nan as npnan
+from numpy import nonzero
+from numpy import sign as npsign
+from numpy import where
+from numpy import zeros
+
+# flag bits, the netCDF flag variables use flag_masks/flag_meanings
+RANGE_FAIL = 1
+STEP_FAIL = 2
+SPIKE_FAIL = 4
+STUCK_FAIL = 8
+INCONSISTENT = 16
+FLAG_MASKS = [RANGE_FAIL, STEP_FAIL, SPIKE_FAIL, STUCK_FAIL, INCONSISTENT]
+FLAG_MEANINGS = 'range_fail step_fail spike_fail stuck_fail inconsistent'
+
+# missing values in the Wunderground data
+MISSING_VALUE = -999
+
+# maximum time (seconds) between two samples for the step test
+STEP_WINDOW = 1800
+
+# limits per raw field name:
+#   range: physical (min, max)
+#   step: maximum change between consecutive samples
+#   spike: minimum jump up and back down (or vice versa) to flag a spike
+#   stuck: maximum duration (seconds) of an unchanged value
+QC_LIMITS = {
+    'TemperatureC': {'range': (-40., 50.), 'step': 5., 'spike': 3.,
+                     'stuck': 14400},
+    'TemperatureF': {'range': (-40., 122.), 'step': 9., 'spike': 5.4,
+                     'stuck': 14400},
+    'DewpointC': {'range': (-50., 35.), 'step': 5., 'spike': 3.,
+                  'stuck': 14400},
+    'DewpointF': {'range': (-58., 95.), 'step': 9., 'spike': 5.4,
+                  'stuck': 14400},
+    'PressurehPa': {'range': (900., 1085.), 'step': 3., 'spike': 2.,
+                    'stuck': 21600},
+    'PressureIn': {'range': (26.6, 32.), 'step': 0.09, 'spike': 0.06,
+                   'stuck': 21600},
+    'Humidity': {'range': (0., 100.), 'step': 30., 'spike': 20.,
+                 'stuck': None},
+    'WindDirectionDegrees': {'range': (0., 360.), 'step': None,
+                             'spike': None, 'stuck': None},
+    'WindSpeedKMH': {'range': (0., 200.), 'step': None, 'spike': 50.,
+                     'stuck': None},
+    'WindSpeedGustKMH': {'range': (0., 300.), 'step': None, 'spike': None,
+                         'stuck': None},
+    'WindSpeedMPH': {'range': (0., 125.), 'step': None, 'spike': 31.,
+                     'stuck': None},
+    'WindSpeedGustMPH': {'range': (0., 185.), 'step': None, 'spike': None,
+                         'stuck': None},
+    'HourlyPrecipMM': {'range': (0., 300.), 'step': None, 'spike': None,
+                       'stuck': None},
+    'HourlyPrecipIn': {'range': (0., 12.), 'step': None, 'spike': None,
+                       'stuck': None},
+    'dailyrainMM': {'range': (0., 500.), 'step': None, 'spike': None,
+                    'stuck': None},
+    'dailyrainin': {'range': (0., 20.), 'step': None, 'spike': None,
+                    'stuck': None},
+    'SolarRadiationWatts/m^2': {'range': (0., 1500.), 'step': None,
+                                'spike': None, 'stuck': None},
+    }
+
+# pairs of fields (lower, upper) where lower should not exceed upper
+QC_CONSISTENCY = [('DewpointC', 'TemperatureC'),
+                  ('DewpointF', 'TemperatureF'),
+                  ('WindSpeedKMH', 'WindSpeedGustKMH'),
+                  ('WindSpeedMPH', 'WindSpeedGustMPH')]
+
+def range_check(values, limits):
+    '''
+    return True where values are outside the (min, max) limits
+    '''
+    with errstate(invalid='ignore'):
+        return (values < limits[0]) | (values > limits[1])
+
+def step_check(epochs, values, max_step):
+    '''
+    return True where the change from the previous sample exceeds max_step,
+    only samples at most STEP_WINDOW seconds apart are compared
+    '''
+    with errstate(invalid='ignore'):
+        step = ((npabs(npdiff(values)) > max_step) &
+                (npdiff(epochs) <= STEP_WINDOW))
+    return npconcatenate(([False], step))
+
+def spike_check(values, max_spike):
+    '''
+    return True for samples that jump away from both neighbours in the
+    same direction by more than max_spike
+    '''
+    if len(values) < 3:
+        return zeros(len(values), dtype=bool)
+    before = values[1:-1] - values[:-2]
+    after = values[2:] - values[1:-1]
+    with errstate(invalid='ignore'):
+        spike = ((npsign(before) == -npsign(after)) &
+                 (npabs(before) > max_spike) & (npabs(after) > max_spike))
+    return npconcatenate(([False], spike, [False]))
+
+def stuck_check(epochs, values, max_duration):
+    '''
+    return True for samples in a run of identical values that lasts longer
+    than max_duration seconds
+    '''
+    if len(values) == 0:
+        return zeros(0, dtype=bool)
+    # number the runs of identical values
+    run = cumsum(npappend([0], values[1:] != values[:-1]))
+    # duration of each run from its first to its last sample
+    first = npappend([True], run[1:] != run[:-1])
+    last = npappend(run[1:] != run[:-1], [True])
+    duration = epochs[last] - epochs[first]
+    stuck = duration > max_duration
+    return stuck[run] & ~isnan(values)
+
+def qc_flags(epochs, data):
+    '''
+    return a dictionary with the bit flags (int8) of every field in data
+    that has QC_LIMITS, epochs is the UTC time axis in seconds and data the
+    dictionary of typed columns of process_raw_data
+    '''
+    flags = {}
+    checked = {}
+    for field_name, limits in QC_LIMITS.items():
+        values = data.get(field_name)
+        if values is None or values.dtype == object:
+            # field not available or not numeric
+            continue
+        # missing values are not checked
+        values = where(values == MISSING_VALUE, npnan, values)
+        flag = zeros(len(values), dtype='int8')
+        flag[range_check(values, limits['range'])] |= RANGE_FAIL
+        if limits['step'] is not None:
+            flag[step_check(epochs, values, limits['step'])] |= STEP_FAIL
+        if limits['spike'] is not None:
+            flag[spike_check(values, limits['spike'])] |= SPIKE_FAIL
+        if limits['stuck'] is not None:
+            flag[stuck_check(epochs, values, limits['stuck'])] |= STUCK_FAIL
+        flags[field_name] = flag
+        checked[field_name] = values
+    for lower, upper in QC_CONSISTENCY:
+        if lower in flags and upper in flags:
+            with errstate(invalid='ignore'):
+                inconsistent = checked[lower] > checked[upper]
+            flags[lower][inconsistent] |= INCONSISTENT
+            flags[upper][inconsistent] |= INCONSISTENT
+    return flags
+
+def tail_length(data):
+    '''
+    return the number of samples at the end of data (dictionary of float
+    columns of the same length) that a check of the next samples depends
+    on: the last two samples for the step and spike checks and the open
+    run of identical values for the stuck check
+    '''
+    length = 2
+    for field_name, values in data.items():
+        if (len(values) == 0 or isnan(values[-1]) or
+                QC_LIMITS.get(field_name, {}).get('stuck') is None):
+            continue
+        changed = nonzero(values != values[-1])[0]
+        length = max(length, len(values) - (changed[-1] + 1 if
+                                            len(changed) else 0))
+    return length
@@ -0,0 +1,227 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Query a time window of variables for a set of stations from
+                the netCDF files in an output directory:
+                    * update_index(outputdir)
+                    * query(outputdir, variables, startdate, enddate, ...)
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:
+Last Modified:
+License:        Apache 2.0
+Notes:          * A small json index with the time range, variables and
+                  location of every <station>.nc file is kept in the
+                  output directory, files are only opened if they overlap
+                  the query
+                * The time window is converted to an index slice by binary
+                  search on the (sorted) time axis, only that slice is read
+'''
+
+import bisect
+import calendar
+import csv
+import glob
+import json
+import os
+import sys
+from datetime import datetime
+from multiprocessing import Pool
+from netCDF4 import Dataset as ncdf
+from netCDF4 import date2num as ncdf_date2num
+from netCDF4 import num2date as ncdf_num2date
+from numpy import array as nparray
+from numpy import concatenate as npconcatenate
+from numpy import full
+from numpy import nan as npnan
+from numpy import zeros
+
+INDEX_FILE = 'wunderground_index.json'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# seconds per time unit of the netCDF time axis
+TIME_UNITS = {'seconds': 1, 'minutes': 60, 'hours': 3600, 'days': 86400}
+
+def update_index(outputdir):
+    '''
+    return the station index of outputdir, netCDF files that are new or
+    changed since the index was written are (re)indexed
+    '''
+    indexfile = os.path.join(outputdir, INDEX_FILE)
+    try:
+        with open(indexfile, 'r') as fp:
+            index = json.load(fp)
+    except (IOError, ValueError):
+        index = {}
+    updated = {}
+    for filename in sorted(glob.glob(os.path.join(outputdir, '*.nc'))):
+        stationid = os.path.splitext(os.path.basename(filename))[0]
+        mtime = os.path.getmtime(filename)
+        if stationid in index and index[stationid]['mtime'] == mtime:
+            updated[stationid] = index[stationid]
+            continue
+        try:
+            updated[stationid] = index_station(filename)
+        except (IOError, RuntimeError, IndexError, KeyError):
+            # not a (complete) station file
+            continue
+        updated[stationid]['mtime'] = mtime
+    if updated != index:
+        with open(indexfile, 'w') as fp:
+            json.dump(updated, fp, indent=1, sort_keys=True)
+    return updated
+
+def index_station(filename):
+    '''
+    return the index entry (time range, variables, groups, location) of a
+    station netCDF file
+    '''
+    ncfile = ncdf(filename, 'r')
+    try:
+        timevar = ncfile.variables['time']
+        entry = {'file': os.path.basename(filename),
+                 'start': time_string(timevar, timevar[0]),
+                 'end': time_string(timevar, timevar[-1]),
+                 'variables': sorted(ncfile.variables.keys()),
+                 'groups': {name: sorted(group.variables.keys()) for
+                            name, group in ncfile.groups.items()}}
+        for coordinate in ['latitude', 'longitude']:
+            if coordinate in ncfile.variables:
+                entry[coordinate] = float(ncfile.variables[coordinate][0])
+    finally:
+        ncfile.close()
+    return entry
+
+def time_string(timevar, value):
+    '''
+    return a value of the netCDF time axis timevar as string
+    '''
+    return ncdf_num2date(value, units=timevar.units,
+                         calendar=timevar.calendar).strftime(DATE_FORMAT)
+
+class time_axis:
+    '''
+    sequence view on a netCDF time variable that reads single values on
+    request, used for binary search without reading the full axis
+    '''
+    def __init__(self, timevar):
+        self.timevar = timevar
+
+    def __len__(self):
+        return len(self.timevar)
+
+    def __getitem__(self, idx):
+        return self.timevar[idx]
+
+def read_station(args):
+    '''
+    read the time window [startdate, enddate] of variables from a station
+    netCDF file. Input argument args consists of (filename, group,
+    variables, startdate, enddate). Returns the time (epoch seconds) and a
+    dictionary with an array per variable, variables that are not in the
+    file are nan. String variables are returned as object arrays of str.
+    '''
+    filename, group, variables, startdate, enddate = args
+    ncfile = ncdf(filename, 'r')
+    try:
+        dataset = ncfile.groups[group] if group else ncfile
+        timevar = dataset.variables['time']
+        axis = time_axis(timevar)
+        first = bisect.bisect_left(axis, ncdf_date2num(
+            startdate, units=timevar.units, calendar=timevar.calendar))
+        last = bisect.bisect_right(axis, ncdf_date2num(
+            enddate, units=timevar.units, calendar=timevar.calendar))
+        epochs = timevar[first:last].astype('int64')
+        unit, reference = timevar.units.split(' since ')
+        epochs = epochs * TIME_UNITS[unit] + calendar.timegm(
+            datetime.strptime(reference.strip(), DATE_FORMAT).timetuple())
+        data = {}
+        for variable in variables:
+            if variable in dataset.variables:
+                values = dataset.variables[variable][first:last]
+                if values.dtype.kind in 'OSU':
+                    # string variable, e.g. WindDirection
+                    data[variable] = nparray(
+                        [v.encode('utf-8') if isinstance(v, unicode) else
+                         str(v) for v in values], dtype=object)
+                else:
+                    data[variable] = values.astype(float).filled(npnan) if \
+                        hasattr(values, 'filled') else values.astype(float)
+            else:
+                data[variable] = full(len(epochs), npnan)
+    finally:
+        ncfile.close()
+    return epochs, data
+
+def query(outputdir, variables, startdate, enddate, stations=None,
+          group=None, processes=8):
+    '''
+    return the time window [startdate, enddate] (datetime objects) of
+    variables for stations (default all stations) as numpy structured
+    array with the fields station, time (datetime64[s]) and one field per
+    variable, float for numeric variables and object (str) for string
+    variables. group selects an aggregate group (hourly/daily) instead of
+    the raw data.
+    '''
+    index = update_index(outputdir)
+    start = startdate.strftime(DATE_FORMAT)
+    end = enddate.strftime(DATE_FORMAT)
+    selected = []
+    for stationid in sorted(index.keys()):
+        entry = index[stationid]
+        if stations and stationid not in stations:
+            continue
+        if entry['end'] < start or entry['start'] > end:
+            # station does not overlap the time window
+            continue
+        available = entry['groups'].get(group, []) if group else \
+            entry['variables']
+        if not any(variable in available for variable in variables):
+            continue
+        selected.append(stationid)
+    args = [(os.path.join(outputdir, index[stationid]['file']), group,
+             variables, startdate, enddate) for stationid in selected]
+    if len(args) > 1 and processes > 1:
+        pool = Pool(min(processes, len(args)))
+        results = pool.map(read_station, args)
+        pool.close()
+        pool.join()
+    else:
+        results = [read_station(arg) for arg in args]
+    # a variable that is a string variable in any of the stations is
+    # returned as object field
+    strings = [v for v in variables if any(
+        data[v].dtype == object for epochs, data in results)]
+    dtype = [('station', 'S' + str(max([len(s) for s in selected] + [1]))),
+             ('time', 'datetime64[s]')] + [
+                 (str(v), object if v in strings else 'f8') for v in
+                 variables]
+    records = [zeros(0, dtype=dtype)]
+    for stationid, (epochs, data) in zip(selected, results):
+        station = zeros(len(epochs), dtype=dtype)
+        station['station'] = stationid
+        station['time'] = epochs
+        for variable in variables:
+            if variable in strings and data[variable].dtype != object:
+                # missing string values are empty
+                station[str(variable)] = [
+                    '' if value != value else str(value) for value in
+                    data[variable]]
+            else:
+                station[str(variable)] = data[variable]
+        records.append(station)
+    return npconcatenate(records)
+
+def write_query_csv(records, csvfile):
+    '''
+    write the result of query to a csv file (- for stdout)
+    '''
+    fp = sys.stdout if csvfile == '-' else open(csvfile, 'w')
+    try:
+        writer = csv.writer(fp, delimiter=',')
+        writer.writerow(records.dtype.names)
+        for record in records:
+            writer.writerow([record['station'], str(record['time'])] +
+                            [record[name] for name in
+                             records.dtype.names[2:]])
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
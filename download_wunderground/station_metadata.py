@@ -0,0 +1,182 @@
+#!/usr/bin/env python2
+
+'''
+Description:    Station metadata (location, zipcode, listing info) cache
+                shared by the download and the netCDF conversion:
+                    * station_metadata(filename)
+                    * station_metadata.import_csvfile(csvfile)
+                    * station_metadata.get(stationid)
+                    * station_metadata.location(stationid)
+Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
+Created:
+Last Modified:
+License:        Apache 2.0
+Notes:          * Stations are stored in a SQLite table and held in memory
+                  as a dictionary by station id, the table is reloaded when
+                  another process changed it
+                * Missing locations are looked up on Wunderground once and
+                  written back, failed lookups are remembered as well
+'''
+
+import csv
+import logging
+import os
+import sqlite3
+import time
+
+METADATA_FILE = 'wunderground_stations.db'
+# columns of the station table, the csv file of wunderground_dump_stationid
+# uses the csv names
+METADATA_COLUMNS = ['stationid', 'neighborhood', 'city', 'station_type',
+                    'lat', 'lon', 'height', 'zipcode', 'located']
+CSV_COLUMNS = {'Station ID': 'stationid', 'Neighborhood': 'neighborhood',
+               'City': 'city', 'Station Type': 'station_type', 'lat': 'lat',
+               'lon': 'lon', 'height': 'height', 'zipcode': 'zipcode'}
+NUMERIC_COLUMNS = ['lat', 'lon', 'height', 'located']
+
+logger = logging.getLogger()
+
+class station_metadata:
+    '''
+    Cache of station metadata in the SQLite file filename. Lookups by
+    station id are served from memory.
+    '''
+    def __init__(self, filename=METADATA_FILE):
+        self.filename = filename
+        self.stations = {}
+        self.mtime = None
+        # the cache is opened before the output directory is used
+        directory = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        connection = self.connect()
+        try:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS stations (stationid TEXT ' +
+                'PRIMARY KEY, neighborhood TEXT, city TEXT, station_type ' +
+                'TEXT, lat REAL, lon REAL, height REAL, zipcode TEXT, ' +
+                'located REAL)')
+            connection.commit()
+        finally:
+            connection.close()
+        self.reload()
+
+    def connect(self):
+        '''
+        return a new connection to the metadata file, connections are not
+        kept open so the cache can be used before forking
+        '''
+        connection = sqlite3.connect(self.filename, timeout=60)
+        # utf-8 byte strings like the rest of the package
+        connection.text_factory = str
+        return connection
+
+    def reload(self):
+        '''
+        (re)load the station table in memory if the file changed since the
+        last load
+        '''
+        mtime = os.path.getmtime(self.filename)
+        if mtime == self.mtime:
+            return
+        connection = self.connect()
+        try:
+            rows = connection.execute('SELECT ' + ', '.join(
+                METADATA_COLUMNS) + ' FROM stations').fetchall()
+        finally:
+            connection.close()
+        self.stations = {row[0]: dict(zip(METADATA_COLUMNS, row)) for row
+                         in rows}
+        self.mtime = mtime
+
+    def get(self, stationid):
+        '''
+        return the metadata of stationid as dictionary, None if the station
+        is unknown
+        '''
+        self.reload()
+        return self.stations.get(stationid)
+
+    def update(self, records):
+        '''
+        insert or update stations from a list of dictionaries with (a
+        subset of) METADATA_COLUMNS, empty values do not replace known
+        values
+        '''
+        connection = self.connect()
+        try:
+            for record in records:
+                record = {k: v for k, v in record.items() if v not in
+                          [None, '']}
+                columns = [c for c in METADATA_COLUMNS if c in record]
+                connection.execute(
+                    'INSERT OR IGNORE INTO stations (stationid) VALUES (?)',
+                    (record['stationid'],))
+                connection.execute(
+                    'UPDATE stations SET ' + ', '.join(
+                        [c + ' = ?' for c in columns]) +
+                    ' WHERE stationid = ?',
+                    [record[c] for c in columns] + [record['stationid']])
+            connection.commit()
+        finally:
+            connection.close()
+        # the file may change within the mtime resolution, always reload
+        self.mtime = None
+        self.reload()
+
+    def import_csvfile(self, csvfile):
+        '''
+        add the stations of a csv file written by wunderground_dump_stationid
+        and return their station ids in file order
+        '''
+        logger.info('Load stationdata from csv file')
+        records = []
+        with open(csvfile, 'r') as csvin:
+            reader = csv.DictReader(csvin, delimiter=',')
+            for line in reader:
+                record = {CSV_COLUMNS[k.strip()]: v.strip() for k, v in
+                          line.items() if k is not None and v is not None
+                          and k.strip() in CSV_COLUMNS}
+                for column in NUMERIC_COLUMNS:
+                    try:
+                        record[column] = float(record[column])
+                    except (KeyError, ValueError):
+                        record.pop(column, None)
+                if record.get('stationid'):
+                    records.append(record)
+        self.update(records)
+        return [record['stationid'] for record in records]
+
+    def location(self, stationid, lookup=True):
+        '''
+        return the (lat, lon) of stationid, (False, False) if unknown. A
+        missing location is looked up on Wunderground if lookup is True,
+        the result is written back so every station is looked up at most
+        once. A station page without a valid location is remembered as
+        well, a lookup that failed on the network is tried again next time.
+        '''
+        station = self.get(stationid) or {}
+        if station.get('lat') is not None and station.get('lon') is not None:
+            return station['lat'], station['lon']
+        if not lookup or station.get('located') is not None:
+            return False, False
+        # lxml is only needed for the lookup
+        from download_wunderground.wunderground_dump_stationid import \
+            get_station_location
+        logger.info('Get station location of stationid: ' + stationid)
+        try:
+            location = get_station_location(stationid)
+        except IOError as e:
+            # network failure, the station is not marked as located
+            logger.error('Could not get the location of ' + stationid +
+                         ': ' + str(e))
+            return False, False
+        except (ValueError, KeyError) as e:
+            logger.error('No valid location for ' + stationid + ': ' +
+                         str(e))
+            location = {}
+        location.update({'stationid': stationid, 'located': time.time()})
+        self.update([location])
+        if 'lat' in location and 'lon' in location:
+            return location['lat'], location['lon']
+        return False, False
@@ -7,6 +7,9 @@ Description:    Shared functionality:
                     * is_number(s)
                     * wind_components(wind_speed, wind_direction)
                     * ismember(a, b)
+                    * typed_column(values)
+                    * host_limiter(limit)
+                    * http_session()
 Author:         Ronald van Haren, NLeSC (r.vanharen@esciencecenter.nl)
 Created:
 Last Modified:
@@ -16,10 +19,12 @@ Notes:
 
 import logging
 import sys
-from numpy import sin as npsin
-from numpy import cos as npcos
-from numpy import radians as npradians
 import csv
+import threading
+import httplib
+import socket
+from contextlib import contextmanager
+from urlparse import urlparse, urljoin
 from math import radians, cos, sin, asin, sqrt
 
 # define global LOG variables
@@ -83,6 +88,9 @@ def wind_components(wind_speed, wind_direction):
     return U and V wind components from wind speed and 
     wind direction (in degrees)
     '''
+    from numpy import sin as npsin
+    from numpy import cos as npcos
+    from numpy import radians as npradians
     U = wind_speed * npsin(npradians(wind_direction)) * -1
     V = wind_speed * npcos(npradians(wind_direction)) * -1
     return U, V
@@ -149,3 +157,115 @@ def progressbar2(_i, count, prefix="", size=60):
     sys.stdout.write("%s[%s%s] %i/%i\r" % (prefix, "#"*x, "."*(size-x),
                                             _i, count))
     sys.stdout.flush()
+
+def typed_column(values):
+    '''
+    convert a numpy array of strings to a float array if it contains any
+    number (non-numeric values become nan), otherwise return it unchanged
+    '''
+    from numpy import array as nparray
+    from numpy import nan as npnan
+    try:
+        # fast path, every value is a number
+        return values.astype(float)
+    except ValueError:
+        pass
+    items = [fitem(c) for c in values]
+    if not any(isinstance(c, float) for c in items):
+        return values
+    return nparray([c if isinstance(c, float) else npnan for c in items],
+                   dtype=float)
+
+class host_limiter:
+    '''
+    limit the number of simultaneous connections per host, shared by all
+    threads of a process
+    '''
+    def __init__(self, limit=4):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    @contextmanager
+    def limited(self, url):
+        '''
+        context manager that holds a connection slot for the host of url
+        '''
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.limit)
+            semaphore = self.semaphores[host]
+        with semaphore:
+            yield
+
+class http_session:
+    '''
+    HTTP client with persistent (keep-alive) connections that can be shared
+    by the threads of a download pool, every thread reuses its own
+    connection per host
+    '''
+    def __init__(self, timeout=60, max_redirects=5):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.local = threading.local()
+
+    def connection(self, scheme, host, new=False):
+        '''
+        return the connection of the current thread to host, a new
+        connection is opened if new is True or none exists yet
+        '''
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        key = (scheme, host)
+        if new and key in self.local.connections:
+            self.local.connections.pop(key).close()
+        if key not in self.local.connections:
+            connection_class = httplib.HTTPSConnection if \
+                scheme == 'https' else httplib.HTTPConnection
+            self.local.connections[key] = connection_class(
+                host, timeout=self.timeout)
+        return self.local.connections[key]
+
+    def get(self, url):
+        '''
+        return the body of url, redirects are followed and errors raise an
+        IOError like urllib2.urlopen
+        '''
+        return self.request(url)[2]
+
+    def request(self, url, headers=None):
+        '''
+        return the status, the (lower case) response headers and the body of
+        a GET of url with the extra request headers. Redirects are followed,
+        304 Not Modified is returned and other errors raise an IOError.
+        '''
+        for _ in range(self.max_redirects + 1):
+            parsed = urlparse(url)
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+            for retry in [False, True]:
+                # a kept-alive connection may have been closed by the server
+                connection = self.connection(parsed.scheme, parsed.netloc,
+                                             new=retry)
+                try:
+                    connection.request('GET', path, headers=headers or {})
+                    response = connection.getresponse()
+                    body = response.read()
+                    break
+                except (httplib.HTTPException, socket.error) as e:
+                    connection.close()
+                    if retry:
+                        raise IOError('Cannot download ' + url + ': ' +
+                                      str(e))
+            if response.will_close:
+                connection.close()
+            if response.status in [301, 302, 303, 307, 308]:
+                url = urljoin(url, response.getheader('location'))
+                continue
+            if response.status >= 400:
+                raise IOError('HTTP ' + str(response.status) + ' for ' + url)
+            return response.status, dict(response.getheaders()), body
+        raise IOError('Too many redirects for ' + url)
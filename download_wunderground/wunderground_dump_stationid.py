@@ -9,78 +9,197 @@ License:        Apache 2.0
 Notes:          -
 '''
 
-from lxml.html import parse
 import csv
+import logging
+import os
+import urllib
 import urllib2
+from lxml import etree
 from lxml import html
 import numbers
 import json
-from numpy import concatenate
 import sys
-from multiprocessing import Pool, Manager, cpu_count
-import time
-from numpy import vstack
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
 import shutil
 import argparse
+import download_wunderground.utils as utils
 
-def get_stationids(processes=cpu_count()):
-    '''
-    default multiprocesses to the number of cpu cores
-    '''
-    url='http://dutch.wunderground.com/weatherstation/ListStations.asp?selectedCountry=Netherlands'
-    page = parse(url)
-    # header 
-    rows = page.xpath(".//table[@id='pwsTable']/thead/tr")
-    header = [c.text for idx, c in enumerate(rows[0].getchildren())][:-1]
-    # add location/zipcode to header
-    header = concatenate((header, ['lat', 'lon', 'height', 'zipcode']))
-    rows = page.xpath(".//table[@id='pwsTable']/tbody/tr")
-    data = list()
-    for row in rows:
-        data.append([c.text if idx>0 else c.getchildren()[0].text for idx,
-                     c in enumerate(row.getchildren())])
-    data = [row[:-1] for row in data]
-    pool = Pool(processes) # process per core
-    m = Manager()
-    q = m.Queue()
-    args = [(i, q) for i in data]
-    result = pool.map_async(append_location_zipcode, args)
-    # monitor loop
-    while True:
-        if result.ready():
-            progressbar2(len(data), len(data), prefix="Extracting: ", size=60)
-            sys.stdout.write("\n")
+# Wunderground host, can be replaced by a server with recorded pages
+WUNDERGROUND_URL = 'http://dutch.wunderground.com'
+# path of the station listing, the country name is appended
+LISTING_PATH = '/weatherstation/ListStations.asp?selectedCountry='
+# path of the station dashboard, the stationid is appended
+DASHBOARD_PATH = '/personal-weather-station/dashboard?ID='
+DEFAULT_COUNTRIES = ['Netherlands']
+# seconds before a lookup of a station page is given up
+URL_TIMEOUT = 60
+# regions that can be used instead of a list of countries
+REGIONS = {'Western Europe': ['Netherlands', 'Belgium', 'Luxembourg',
+                              'France', 'Germany', 'Austria', 'Switzerland',
+                              'United Kingdom', 'Ireland', 'Liechtenstein',
+                              'Monaco'],
+           'Benelux': ['Netherlands', 'Belgium', 'Luxembourg']}
+LOCATION_HEADER = ['lat', 'lon', 'height', 'zipcode']
+
+# simultaneous connections per host of all crawler threads
+limiter = utils.host_limiter(4)
+logger = logging.getLogger()
+
+def expand_regions(names):
+    '''
+    return the countries of a list of country and/or region names (see
+    REGIONS), without duplicates
+    '''
+    countries = []
+    for name in names:
+        for country in REGIONS.get(name, [name]):
+            if country not in countries:
+                countries.append(country)
+    return countries
+
+def iter_listing(country, base_url=WUNDERGROUND_URL):
+    '''
+    parse the station listing of country incrementally, yield the header
+    and then the rows of the station table as lists of strings. Parsed rows
+    are removed from the tree, so memory use does not grow with the size
+    of the listing.
+    '''
+    url = base_url + LISTING_PATH + urllib.quote(country)
+    with limiter.limited(url):
+        handler = urllib2.urlopen(url)
+        try:
+            for event, row in etree.iterparse(handler, events=('end',),
+                                              tag='tr', html=True):
+                section = row.getparent()
+                table = section.getparent() if section is not None else None
+                if table is not None and table.get('id') == 'pwsTable':
+                    cells = row.getchildren()
+                    if section.tag == 'thead':
+                        yield [cell_text(c) for c in cells][:-1]
+                    elif section.tag == 'tbody':
+                        # the first cell contains the stationid as link
+                        yield [cell_text(c.getchildren()[0] if idx == 0 and
+                                         len(c) else c)
+                               for idx, c in enumerate(cells)][:-1]
+                    # remove the row and its already parsed predecessors
+                    row.clear()
+                    while row.getprevious() is not None:
+                        del section[0]
+        finally:
+            handler.close()
+
+def cell_text(cell):
+    '''
+    return the stripped utf-8 text of a table cell
+    '''
+    return (cell.text or '').strip().encode('utf-8')
+
+def crawl_listing(args):
+    '''
+    put the header and rows of the listing of a country on a queue.
+    Input argument args consists of (country, base_url, q), where q
+    receives ('header', row) for the first row, ('row', row) for the
+    station rows and ('done', country) when the listing is finished
+    '''
+    country, base_url, q = args
+    try:
+        for idx, row in enumerate(iter_listing(country, base_url)):
+            q.put(('header' if idx == 0 else 'row', row))
+    except (IOError, etree.LxmlError) as e:
+        logger.warning('Cannot list stations of ' + country + ': ' + str(e))
+    finally:
+        q.put(('done', country))
+
+def iter_listings(countries, base_url=WUNDERGROUND_URL, threads=4):
+    '''
+    crawl the listings of countries concurrently and yield the header of
+    the station table once, followed by the station rows. Stations that
+    are listed for more than one country are yielded once.
+    '''
+    q = Queue(maxsize=1000)
+    pool = ThreadPool(min(threads, len(countries)) or 1)
+    pool.map_async(crawl_listing, [(country, base_url, q) for country in
+                                   countries])
+    try:
+        header = None
+        seen = set()
+        done = 0
+        while done < len(countries):
+            kind, row = q.get()
+            if kind == 'done':
+                done += 1
+            elif kind == 'header':
+                if header is None:
+                    header = row
+                    yield header
+            elif row and row[0] not in seen:
+                seen.add(row[0])
+                yield row
+    finally:
+        pool.close()
+
+def get_stationids(countries=DEFAULT_COUNTRIES, processes=cpu_count(),
+                   base_url=WUNDERGROUND_URL, host_limit=None):
+    '''
+    yield the header and the unique station rows of the listings of
+    countries (or regions), extended with the location and zipcode of the
+    station. Listings are crawled concurrently and rows are yielded as
+    soon as their location lookup completes. Connections per host are
+    limited by limiter.
+    default number of simultaneous lookups to the number of cpu cores
+    '''
+    if host_limit:
+        limiter.limit = host_limit
+    listing = iter_listings(expand_regions(countries), base_url,
+                            threads=processes)
+    try:
+        header = next(listing)
+    except StopIteration:
+        return
+    yield header + LOCATION_HEADER
+    # lookups are network bound, threads share the per-host limits
+    pool = ThreadPool(processes)
+    try:
+        count = 0
+        for row in pool.imap_unordered(
+                partial(append_location_zipcode, base_url=base_url),
+                listing):
+            count += 1
+            sys.stdout.write('Extracting: %i stations\r' % count)
             sys.stdout.flush()
-            break
-        else:
-            length = q.qsize()            
-            progressbar2(length, len(data), prefix="Extracting: ", size=60)
-            time.sleep(1)
-    data_out = result.get()
-    # clean up
-    pool.close()
-    pool.join()
-    # check if the output datat and header have the same dimension
-    if len(data_out[0]) == len(header):
-        # add the header to the output data if they have the same dimension
-        data_out = vstack((header, data_out))
-    return data_out
-        
-def append_location_zipcode(args):
+            yield row
+        sys.stdout.write('\n')
+        sys.stdout.flush()
+    finally:
+        # clean up
+        pool.close()
+        pool.join()
+
+def append_location_zipcode(row, base_url=WUNDERGROUND_URL):
         # get the location of the station using the stationid
         # example:
         # location = {'lat': 52.235, 'lon': 4.814, 'height': 3.0}
-        row, q = args
-        location = get_station_location(row[0])
-        # get the zipcode using the lon/lat location and googlemaps
-        zipcode = get_station_zipcode(location)
-        row = concatenate((row,[location['lat'], location['lon'], location['height'], zipcode]))
-        q.put(row)
-        return [c.encode('utf-8').strip() for c in row]
-        
-def dump_stationids(data_out, csvfile):
+        try:
+            location = get_station_location(row[0], base_url)
+        except (IOError, ValueError, KeyError):
+            # no valid location for this station
+            return row + ['', '', '', 'unknown']
+        try:
+            # get the zipcode using the lon/lat location and googlemaps
+            zipcode = get_station_zipcode(location)
+        except (IOError, ValueError, KeyError):
+            # keep the location if only the zipcode lookup failed
+            zipcode = 'unknown'
+        return row + [str(location.get(c, '')) for c in
+                      LOCATION_HEADER[:-1]] + [zipcode.strip()]
+
+def dump_stationids(rows, csvfile):
     '''
-    write station data to output csv file
+    write station data to output csv file, rows are written (and flushed)
+    as they are produced
     '''
     # move file to ${csvfile}.backup if the csv file already exists
     if os.path.isfile(csvfile):
@@ -88,24 +207,29 @@ def dump_stationids(data_out, csvfile):
     # write data to csv file
     with open(csvfile, 'w') as fp:
         a = csv.writer(fp, delimiter=',')
-        a.writerows(data_out)
+        for row in rows:
+            a.writerow(row)
+            fp.flush()
 
-def get_station_location(stationid):
+def get_station_location(stationid, base_url=WUNDERGROUND_URL,
+                         timeout=URL_TIMEOUT):
     '''
-    get the location of a Wunderground stationid
+    get the location of a Wunderground stationid, raises IOError if the
+    page cannot be loaded and ValueError if the page has no valid location
     '''
     # set url to get the location from
-    url = 'http://dutch.wunderground.com/personal-weather-station/dashboard?ID=' + stationid
+    url = base_url + DASHBOARD_PATH + stationid
     # open and read url
-    handler = urllib2.urlopen(url)
-    content = handler.read()
+    with limiter.limited(url):
+        handler = urllib2.urlopen(url, timeout=timeout)
+        content = handler.read()
     # find the correct html tag that has the location info in it
     tree = html.fromstring(content).find_class('subheading')
     # get the string of the location
     if len(tree) == 1:
         raw_location = str(tree[0].text_content())
     else:
-        raise IOError('Cannot parse location from html file')
+        raise ValueError('Cannot parse location from html file')
     # remove anything non-numeric from the string and create a list
     location_list = [float(s) for s in raw_location.split() if
                      is_number(s)]
@@ -113,6 +237,9 @@ def get_station_location(stationid):
     # create a dictionary for the location
     location = dict(zip(location_items, location_list))
     # check if latitude and longitude are not zero
+    if 'lat' not in location or 'lon' not in location:
+        raise ValueError('Could not extract a valid location for ' +
+                         'stationid: ' + stationid)
     if int(location['lat']) == 0 or int(location['lon']) == 0:
         raise ValueError('Could not extract a valid location for ' +
                          'stationid: ' + stationid)
@@ -129,9 +256,10 @@ def get_station_zipcode(location):
     url = 'https://maps.googleapis.com/maps/api/geocode/json?latlng=' + \
         str(location['lat']) + ',' + str(location['lon'])
     # open url
-    handler = urllib2.urlopen(url)
-    # load json
-    js = json.load(handler)
+    with limiter.limited(url):
+        handler = urllib2.urlopen(url, timeout=URL_TIMEOUT)
+        # load json
+        js = json.load(handler)
     # extract the address_component
     try:
         address_components = js['results'][0]['address_components']
@@ -190,17 +318,26 @@ def progressbar2(_i, count, prefix="", size=60):
 
 if __name__ == "__main__":
     # define argument menu
-    description = 'Extract all Wunderground stations in the Netherlands ' + \
-        'and write the station names and locations to a csv file'
+    description = 'Extract all Wunderground stations in a list of ' + \
+        'countries or regions and write the station names and locations ' + \
+        'to a csv file'
     parser = argparse.ArgumentParser(description=description)
     # fill argument groups
     parser.add_argument('-o', '--output', help='CSV output file',
                         default='wunderground_stations.csv', required=False)
+    parser.add_argument('--countries', help='Countries or regions (' +
+                        ', '.join(sorted(REGIONS)) + ') to list stations of',
+                        nargs='+', default=DEFAULT_COUNTRIES, required=False)
+    parser.add_argument('--url', help='Wunderground host, e.g. a local ' +
+                        'server with recorded pages',
+                        default=WUNDERGROUND_URL, required=False)
+    parser.add_argument('--host-limit', help='Maximum number of ' +
+                        'simultaneous connections per host', type=int,
+                        default=4, required=False)
     # extract user entered arguments
     opts = parser.parse_args()
     
-    # process data
-    process_raw_data(opts)
-
-    stationdata = get_stationids(processes=8)
+    stationdata = get_stationids(countries=opts.countries, processes=8,
+                                 base_url=opts.url,
+                                 host_limit=opts.host_limit)
     dump_stationids(stationdata, opts.output)